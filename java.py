@@ -8,13 +8,14 @@ short_description: Installs Oracle Java 7 on Ubuntu/Fedora.
 description:
     - Installs Oracle Java 7 on Ubuntu/Fedora.
 requirements:
-    - wget
     - alternatives, update-alternatives
 #version_added: null
 notes:
     - "Tested with Ansible v1.3."
     - "Tested on 64-bit Fedora 16."
     - "Undefined behavior if mixed with other Java installations."
+    - "The outcome of the last run is recorded in /var/lib/ansible-java/manifest.json; later runs with the same options return without running any command while the recorded files are unchanged."
+    - "Changes are planned before any is made; in check mode the planned operations are returned as I(plan)."
 options:
     state:
         description:
@@ -24,7 +25,144 @@ options:
         choices: [none, jre, jdk]
     package_location:
         description:
-            - "non-standard URL or filesystem path to Java packages"
+            - "non-standard URL or filesystem path to Java packages; a local directory, or a file listing packages one per line, is scanned as a mirror for the newest matching package"
+        required: false
+        default: None
+    cache_valid_time:
+        description:
+            - "maximum age in seconds of the apt package lists before they are refreshed; C(0) refreshes at most once per run, and only when packages are installed"
+        required: false
+        default: 0
+    cache_dir:
+        description:
+            - "directory of the persistent, content-addressed cache of downloaded packages; an empty value disables the cache"
+        required: false
+        default: /var/cache/ansible-java
+    cache_max_size:
+        description:
+            - "size limit of the package cache in MB, beyond which the least recently used packages are evicted; C(0) means unlimited"
+        required: false
+        default: 1024
+    download_connections:
+        description:
+            - "number of concurrent HTTP range requests used to download a package"
+        required: false
+        default: 4
+    download_retries:
+        description:
+            - "number of attempts for each download request, with exponential backoff between attempts"
+        required: false
+        default: 5
+    download_timeout:
+        description:
+            - "timeout in seconds of each download request"
+        required: false
+        default: 60
+    extract_workers:
+        description:
+            - "number of threads hashing files while homes are deduplicated"
+        required: false
+        default: 4
+    stream:
+        description:
+            - "extract tarballs while they are downloaded instead of storing the archive first; the archive is hashed on the fly and the extracted tree is only moved into place if the digest matches the one recorded in the package cache"
+        required: false
+        default: false
+    verify_version:
+        description:
+            - "confirm the installed version by running the JVM instead of trusting the C(release) file of its home"
+        required: false
+        default: false
+    update_path:
+        description:
+            - "put the C(bin) directory of the installed Java first on the PATH set in the system env file, replacing those of other Java homes; a PATH is never added if the file does not set one"
+        required: false
+        default: false
+    java_tool_options:
+        description:
+            - "value of JAVA_TOOL_OPTIONS in the system env file; an empty value removes it, and by default it is left alone"
+        required: false
+        default: None
+    write_sources:
+        description:
+            - "add and remove apt repositories by editing the files in /etc/apt/sources.list.d directly; add-apt-repository is then only used to add PPAs, whose signing keys it imports"
+        required: false
+        default: true
+    apt_key_file:
+        description:
+            - "local armored key or binary keyring holding the signing key of the JRE repository, imported into /etc/apt/trusted.gpg.d instead of fetching the key from a keyserver"
+        required: false
+        default: None
+    versions:
+        description:
+            - "list of C(kind:version) targets, e.g. C(jre:7) or C(jdk:7u76), installed side by side from tarballs, each under its own home; overrides I(state)"
+        required: false
+        default: None
+    default:
+        description:
+            - "the target of I(versions) that becomes the system Java, set as JAVA_HOME and in the alternatives; defaults to the first one"
+        required: false
+        default: None
+    workers:
+        description:
+            - "number of targets of I(versions) fetched and extracted concurrently"
+        required: false
+        default: 2
+    catalog:
+        description:
+            - "path or URL of a JSON list of releases, each with I(version), I(build), I(arch), I(kind), I(format), I(url), I(size) and I(sha256); replaces the bundled catalog of Oracle builds"
+        required: false
+        default: None
+    max_commands:
+        description:
+            - "fail once this many commands have run, 0 for no limit; counts and timings of the commands run are returned under I(metrics)"
+        required: false
+        default: 0
+    dedup:
+        description:
+            - "after extracting, replace files identical across the homes under the Java directory with hard links (C(hardlink)) or, where the filesystem supports it, reflinks (C(reflink)); homes are hashed once and their digests kept in /var/lib/ansible-java/dedup.json. Files under lib/security and *.properties and *.cfg files, which tools such as keytool rewrite in place, are never hard linked"
+        required: false
+        default: none
+        choices: [none, hardlink, reflink]
+    image_cache:
+        description:
+            - "keep each extracted home as an image under I(cache_dir), by the digest of its package, and reinstall homes from their images with hard links instead of fetching and extracting them again. Images are read-only, files that tools rewrite in place, e.g. cacerts, are copied rather than linked, and I(dedup) covers images as well as homes"
+        required: false
+        default: false
+    delete_in_background:
+        description:
+            - "removed homes are renamed aside during the run; delete them afterwards in a detached process rather than before returning"
+        required: false
+        default: true
+    cds:
+        description:
+            - "dump the default class data sharing archive of each installed home, again whenever the home is reinstalled, and report as I(cds) the startup time it saves by default, against C(-Xshare:off), and whether the JVM maps it"
+        required: false
+        default: false
+    cds_class_lists:
+        description:
+            - "application class lists to dump an archive of each, named after the list and kept beside the default archive; needs a JVM that takes -XX:SharedClassListFile"
+        required: false
+        default: None
+    ergonomics:
+        description:
+            - "write JVM options sized to the cores, memory and cgroup limits of the host: the collector and its threads, and a heap limit if I(ergonomics_heap_percent) is set. C(env) writes them to JAVA_TOOL_OPTIONS, merged with I(java_tool_options), which every JVM on the host reads. Switching back to C(none) clears what was written"
+        required: false
+        default: none
+        choices: [ "none", "env" ]
+    ergonomics_heap_percent:
+        description:
+            - "percent of the host's memory, or of its cgroup limit, to pass as -Xmx with I(ergonomics); every JVM on the host gets this limit, so it is only set when asked for"
+        required: false
+        default: 0
+    ergonomics_options:
+        description:
+            - "options that replace the computed option of the same flag, or the computed collector, e.g. -Xmx2g or -XX:+UseConcMarkSweepGC"
+        required: false
+        default: None
+    metrics_file:
+        description:
+            - "path of a Prometheus textfile collector file to write the run's I(metrics) to, such as /var/lib/node_exporter/ansible_java.prom"
         required: false
         default: None
 """
@@ -32,6 +170,9 @@ options:
 EXAMPLES = """
 # Install the latest JDK.
 - java: state=jdk
+
+# Install a JRE and a JDK side by side, with the JRE as the system Java.
+- java: versions=jre:7,jdk:7u76 default=jre:7
 """
 
 #############################################################################
@@ -39,17 +180,343 @@ EXAMPLES = """
 
 import os
 import re
+import pipes
+import shlex
+import base64
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import httplib
+import json
 import platform
+import Queue
 import tempfile
+import time
 import traceback
 import stat
+import struct
+import tarfile
 import shutil
-from collections import namedtuple
+import threading
+import urllib2
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 #############################################################################
 # Utilities
 #############################################################################
 
+class CommandRunner(object):
+    """Stands in for the module, running every command in one place.
+    
+    Read-only commands are memoized until the next mutating one runs.
+    """
+    
+    # commands that never change the system
+    READONLY = frozenset(('cat', 'cut', 'dpkg-query', 'grep', 'head', 'java', 'javac', 
+                          'ls', 'readlink', 'sort', 'tail', 'uname', 'which',))
+    
+    # arguments that make an otherwise read-only command write
+    WRITES = frozenset(('-Xshare:dump',))
+    
+    # commands that only query given one of these as their first argument
+    QUERIES = {
+        'rpm': ('-q',),
+        'dpkg': ('-l', '-s', '-L', '--list', '--status', '--listfiles', '--print-architecture',),
+        'apt-key': ('list', 'finger', 'export',),
+        'update-alternatives': ('--query', '--display', '--list', '--get-selections',),
+        'alternatives': ('--display', '--list',),
+    }
+    
+    def __init__(self, module, limit=0):
+        self.module = module
+        self.limit = limit
+        self.lock = threading.RLock()
+        self.memo = {}
+        self.generation = 0
+        self.counts = {'commands': 0, 'readonly': 0, 'mutating': 0, 'memoized': 0,}
+        self.seconds = 0.0
+        self.timings = {}
+        self.metrics = Metrics()
+    
+    def __getattr__(self, name):
+        # everything but running commands is the module's
+        return getattr(self.module, name)
+    
+    @staticmethod
+    def stages(args):
+        # a shell string is a pipeline of argument lists
+        if isinstance(args, (list, tuple)):
+            return [list(args)]
+        stages = []
+        for stage in args.split('|'):
+            argv = shlex.split(stage)
+            # skip leading variable assignments
+            while argv and re.match(r'^\w+=', argv[0]):
+                argv.pop(0)
+            stages.append(argv)
+        return stages
+    
+    @classmethod
+    def name(cls, args):
+        try:
+            stages = cls.stages(args)
+        except ValueError:
+            return str(args)
+        return ' | '.join([os.path.basename(argv[0]) if argv else '' for argv in stages])
+    
+    @classmethod
+    def readonly(cls, args):
+        # a pipeline is read-only if every stage is, and anything unknown mutates
+        try:
+            stages = cls.stages(args)
+        except ValueError:
+            return False
+        for argv in stages:
+            if not argv:
+                return False
+            name = os.path.basename(argv[0])
+            if cls.WRITES.intersection(argv):
+                return False
+            if name in cls.READONLY:
+                continue
+            flags = cls.QUERIES.get(name)
+            if flags and len(argv) > 1 and argv[1].startswith(flags):
+                continue
+            return False
+        return True
+    
+    def invalidate(self):
+        # called on every mutation, and by callers that change the system themselves
+        with self.lock:
+            self.memo.clear()
+            self.generation += 1
+    
+    def run_command(self, args, check_rc=False, **kwargs):
+        readonly = self.readonly(args)
+        key = repr((args, sorted(kwargs.items())))
+        with self.lock:
+            if readonly:
+                result = self.memo.get(key)
+                # a failure is rerun if it is to be reported
+                if result is not None and (result[0] == 0 or not check_rc):
+                    self.counts['memoized'] += 1
+                    return result
+            if self.limit and self.counts['commands'] >= self.limit:
+                raise RuntimeError("Command limit of %d reached running '%s'" % (self.limit, self.name(args)))
+            self.counts['commands'] += 1
+            self.counts['readonly' if readonly else 'mutating'] += 1
+            generation = self.generation
+        start = time.time()
+        try:
+            result = self.module.run_command(args, check_rc, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            name = self.name(args)
+            with self.lock:
+                self.seconds += elapsed
+                timing = self.timings.setdefault(name, {'count': 0, 'seconds': 0.0})
+                timing['count'] += 1
+                timing['seconds'] += elapsed
+        with self.lock:
+            if not readonly:
+                self.invalidate()
+            elif generation == self.generation:
+                # unless something mutated while this ran
+                self.memo[key] = result
+        return result
+    
+    def report(self):
+        with self.lock:
+            report = dict(self.counts)
+            report['seconds'] = round(self.seconds, 3)
+            report['by_command'] = dict([(name, {'count': timing['count'], 'seconds': round(timing['seconds'], 3)}) 
+                                         for name, timing in self.timings.items()])
+        return report
+
+#############################################################################
+#############################################################################
+
+class AtomicFile(object):
+    """Files replaced whole, so that no reader ever sees them half written.
+    
+    The new content is written and synced to a temporary file next to
+    the path, which is then renamed over it. A replaced file keeps its
+    mode and owner, and a new one gets the mode asked for.
+    """
+    
+    MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+    PRIVATE = stat.S_IRUSR | stat.S_IWUSR
+    
+    @classmethod
+    def write(cls, path, text, mode=None):
+        dirname, filename = os.path.split(path)
+        dirname = dirname or '.'
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % filename, suffix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(path):
+                st = os.stat(path)
+                os.chmod(tmp, stat.S_IMODE(st.st_mode))
+                os.chown(tmp, st.st_uid, st.st_gid)
+            else:
+                os.chmod(tmp, cls.MODE if mode is None else mode)
+            os.rename(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    
+    @classmethod
+    def write_json(cls, path, data, mode=None):
+        cls.write(path, json.dumps(data, indent=1, sort_keys=True, separators=(',', ': ')), mode)
+
+#############################################################################
+#############################################################################
+
+class Metrics(object):
+    """Seconds spent in named phases of a run, summed across threads."""
+    
+    PREFIX = 'ansible_java'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+    
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+    
+    @staticmethod
+    def timer(module, name):
+        # modules not wrapped by a runner are timed into a throwaway
+        metrics = getattr(module, 'metrics', None)
+        if metrics is None:
+            metrics = Metrics()
+        return metrics.phase(name)
+    
+    def report(self):
+        with self.lock:
+            return dict([(name, round(seconds, 3)) for name, seconds in self.phases.items()])
+    
+    @classmethod
+    def textfile(cls, metrics, changed=False):
+        # Prometheus text format, for the node exporter's textfile collector
+        lines = []
+        def gauge(name, text, samples):
+            name = '%s_%s' % (cls.PREFIX, name)
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                labels = ','.join(['%s="%s"' % label for label in sorted(labels.items())])
+                lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '', value))
+        commands = metrics['commands']
+        gauge('last_run_timestamp_seconds', 'When the last run finished.', [({}, int(time.time()))])
+        gauge('run_seconds', 'Seconds the last run took.', [({}, metrics['seconds'])])
+        gauge('changed', 'Whether the last run changed the host.', [({}, int(bool(changed)))])
+        gauge('phase_seconds', 'Seconds the last run spent in each phase.', 
+              [({'phase': name}, seconds) for name, seconds in sorted(metrics['phases'].items())])
+        gauge('downloaded_bytes', 'Bytes downloaded by the last run.', [({}, metrics['bytes_downloaded'])])
+        gauge('extracted_bytes', 'Bytes extracted by the last run.', [({}, metrics['bytes_extracted'])])
+        gauge('extracted_files', 'Files extracted by the last run.', [({}, metrics['files_extracted'])])
+        gauge('reclaimed_bytes', 'Bytes reclaimed by linking identical files in the last run.', 
+              [({}, metrics.get('bytes_reclaimed', 0))])
+        gauge('commands', 'Commands run by the last run.', 
+              [({'kind': kind}, commands.get(kind, 0)) for kind in ('readonly', 'mutating', 'memoized')])
+        gauge('command_seconds', 'Seconds the last run spent in commands.', [({}, commands.get('seconds', 0))])
+        return '\n'.join(lines) + '\n'
+    
+#############################################################################
+#############################################################################
+
+class Plan(object):
+    """Operations that converge the host, planned from its current state.
+    
+    Operations are deduplicated as they are planned, and run grouped by
+    action in the order of ACTIONS, so that each handler sees all the
+    targets of its action at once.
+    """
+    
+    ACTIONS = ('remove', 'remove_repository', 'remove_source', 'remove_key', 'purge',
+               'repository', 'source', 'key', 'update', 'debconf', 'install', 'fetch', 'dedup', 'cds', 'env',)
+    
+    # planning one of these on the same target cancels the other
+    INVERSES = {
+        'install': 'remove',
+        'remove': 'install',
+        'repository': 'remove_repository',
+        'remove_repository': 'repository',
+        'source': 'remove_source',
+        'remove_source': 'source',
+        'key': 'remove_key',
+        'remove_key': 'key',
+    }
+    
+    def __init__(self):
+        self.operations = {}
+    
+    def __len__(self):
+        return sum([len(targets) for targets in self.operations.values()])
+    
+    def add(self, action, target=None):
+        if action not in self.ACTIONS:
+            raise ValueError(action)
+        inverse = self.INVERSES.get(action)
+        if inverse is not None and self.has(inverse, target):
+            self.operations[inverse].remove(target)
+            if not self.operations[inverse]:
+                del self.operations[inverse]
+            return
+        targets = self.operations.setdefault(action, [])
+        if target not in targets:
+            targets.append(target)
+    
+    def has(self, action, target=None):
+        return target in self.operations.get(action, [])
+    
+    def targets(self, action):
+        return list(self.operations.get(action, []))
+    
+    def ordered(self):
+        return [(action, self.operations[action]) for action in self.ACTIONS
+                if action in self.operations]
+    
+    @classmethod
+    def label(cls, target):
+        if isinstance(target, JavaVersion):
+            return target.version_string()
+        if isinstance(target, tuple):
+            return ':'.join([cls.label(t) for t in target if not isinstance(t, bool)])
+        return target
+    
+    def describe(self):
+        return [{'action': action, 'targets': [self.label(t) for t in targets]}
+                for action, targets in self.ordered()]
+    
+    def execute(self, executor):
+        # each action is handled by the executor's execute_<action>
+        changed = False
+        for action, targets in self.ordered():
+            changed = getattr(executor, 'execute_' + action)(targets) or changed
+        return changed
+
+#############################################################################
+#############################################################################
+
 class PackageManager(object):
     pass
 
@@ -58,32 +525,78 @@ class PackageManager(object):
 
 class Yum(PackageManager):
     
-    def __init__(self, module):
+    QUERY_FORMAT = r'%{NAME}\t%{VERSION}-%{RELEASE}\n'
+    
+    @classmethod
+    def parse_query(cls, output):
+        packages = {}
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if len(fields) != 2:
+                continue
+            packages.setdefault(fields[0], set()).add(fields[1])
+        return packages
+    
+    def __init__(self, module, distro):
         self.module = module
+        self.distro = distro
+        self._index = None
     
-    def installed(self, name):
-        args = r"rpm -qa --queryformat '%{NAME}\n' | grep '^" + name + r"$'"
-        result = self.module.run_command(args)
-        return result[0] == 0
+    def index(self):
+        # snapshot of the rpmdb, shared by all lookups until the next change
+        if self._index is None:
+            argv = ['rpm', '-qa', '--queryformat', self.QUERY_FORMAT]
+            result = self.module.run_command(argv, True)
+            self._index = self.parse_query(result[1])
+        return self._index
+    
+    def versions(self, name):
+        return self.index().get(name, set())
+    
+    def installed(self, name, version=None):
+        versions = self.versions(name)
+        if version is None:
+            return len(versions) > 0
+        for v in versions:
+            if v == version or v.startswith(version + '-'):
+                return True
+        return False
     
     def install(self, name):
+        query = None
         if os.path.isfile(name):
-            args = r"rpm -qp --queryformat '%{NAME}\n' " + name
-            result = self.module.run_command(args, True)
-            pkg = result[1].strip()
+            argv = ['rpm', '-qp', '--queryformat', self.QUERY_FORMAT, name]
+            result = self.module.run_command(argv, True)
+            query = self.parse_query(result[1])
+            assert len(query) == 1, result[1]
+            pkg = list(query)[0]
         else:
             pkg = name
         if self.installed(pkg):
             return False
         argv = ['yum', '--nogpgcheck', '-y', 'install', name]
-        self.module.run_command(argv, True)
+        with Metrics.timer(self.module, 'packages'):
+            self.module.run_command(argv, True)
+        if query is not None:
+            # yum replaces any other installed version of the package
+            self._index.update(query)
+        else:
+            # dependencies may have been pulled in too
+            self._index = None
         return True
         
-    def uninstall(self, name):
-        if not self.installed(name):
+    def uninstall(self, names):
+        if isinstance(names, str):
+            names = [names]
+        # one transaction for all of them
+        names = [name for name in names if self.installed(name)]
+        if not names:
             return False
-        argv = ['yum', '-y', 'remove', name]
-        self.module.run_command(argv, True)
+        argv = ['yum', '-y', 'remove'] + names
+        with Metrics.timer(self.module, 'packages'):
+            self.module.run_command(argv, True)
+        for name in names:
+            self.index().pop(name, None)
         return True
     
 #############################################################################
@@ -92,12 +605,10 @@ class Yum(PackageManager):
 # mostly borrowed from ansible apt module code
 class Apt(PackageManager):
     CMD = 'apt-get'
-    PATH = '/usr/bin'
     ENV = {
            'DEBIAN_FRONTEND': 'noninteractive', 
            'DEBIAN_PRIORITY': 'critical',
            }
-    
     @staticmethod
     def package_split(pkgspec):
         parts = pkgspec.split('=')
@@ -106,42 +617,101 @@ class Apt(PackageManager):
         else:
             return parts[0], None
     
-    @classmethod
-    def args(cls):
-        return [' '.join(['%s=%s' % kv for kv in cls.ENV.iteritems()]),
-                os.path.join(cls.PATH, cls.CMD)]
+    def args(self):
+        return [' '.join(['%s=%s' % kv for kv in self.ENV.iteritems()]),
+                os.path.join(self.distro.BIN_DIR, self.CMD)]
+    
+    def sources_signature(self):
+        signature = []
+        distro = self.distro
+        for path in (distro.APT_SOURCES_FILE, distro.APT_SOURCES_DIR,
+                     distro.APT_KEYRING, distro.APT_KEYRING_DIR,):
+            if os.path.isdir(path):
+                paths = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+            else:
+                paths = [path]
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                signature.append((path, st.st_mtime, st.st_size))
+        return tuple(signature)
+    
+    def lists_mtime(self):
+        for path in (self.distro.APT_UPDATE_STAMP, self.distro.APT_LISTS_DIR):
+            if os.path.exists(path):
+                return os.stat(path).st_mtime
+        return None
     
-    def __init__(self, module):
+    def __init__(self, module, distro):
         self.module = module
+        self.distro = distro
+        self.cache_valid_time = int(module.params.get('cache_valid_time') or 0)
+        self._update = False
+        self._force = False
+        self._refreshed = None
+        self._statuses = {}
+        self._generation = None
+        self._pending = set()
+    
+    def prefetch(self, names):
+        # queued names are resolved along with the next query
+        self._pending.update(names)
+    
+    def statuses(self, names):
+        # resolve any number of packages with a single dpkg-query
+        names = list(names)
+        # answers hold until the runner sees a mutation
+        generation = getattr(self.module, 'generation', None)
+        if generation is None or generation != self._generation:
+            self._statuses = {}
+            self._generation = generation
+        missing = set([name for name in names if name not in self._statuses])
+        if missing:
+            missing.update([name for name in self._pending if name not in self._statuses])
+            self._pending.clear()
+            fmt = r'\t'.join([r'${%s}' % s for s in ('package', 'version', 'status')]) + r'\n'
+            argv = ['dpkg-query', '-f', fmt, '-W'] + sorted(missing)
+            # exits nonzero if any name is unknown, but still lists the others
+            result = self.module.run_command(argv)
+            for name in missing:
+                self._statuses[name] = None
+            for line in result[1].splitlines():
+                fields = line.split('\t')
+                if len(fields) == 3:
+                    self._statuses[fields[0]] = fields
+        return dict([(name, self._statuses[name]) for name in names 
+                     if self._statuses.get(name) is not None])
     
     def status(self, name):
-        fmt = r'\t'.join([r'${%s}' % s for s in ('package', 'version', 'status')]) + r'\n'
-        args = r"dpkg-query -f '%s' -W '%s'" % (fmt, name)
-        result = self.module.run_command(args)
-        if result[1]:
-            lines = result[1].splitlines()
-            assert len(lines) == 1, result[1]
-            return lines[0].split('\t')
-        return None
+        return self.statuses([name]).get(name)
     
-    def installed(self, name):
-        status = self.status(name)
-        if not status:
+    @staticmethod
+    def status_installed(status, version=None):
+        if not status or status[2] != 'install ok installed':
             return False
-        return status[2] == 'install ok installed'
+        if version is not None:
+            return fnmatch.fnmatch(status[1], version)
+        return True
+    
+    def installed(self, name):
+        return self.status_installed(self.status(name))
     
     def install(self, pkgspec, upgrade=False, default_release=None, install_recommends=True, force=False):
         packages = []
         if isinstance(pkgspec, str):
             pkgspec = [pkgspec]
-        for package in pkgspec:
-            name, version = self.package_split(package)
-            # FIXME: check version/upgrade
-            if not self.installed(name):
+        pkgspec = [(package,) + self.package_split(package) for package in pkgspec]
+        statuses = self.statuses([name for package, name, version in pkgspec])
+        for package, name, version in pkgspec:
+            # FIXME: check upgrade
+            if not self.status_installed(statuses.get(name), version):
                 packages.append(package)
     
         result = None
         if packages:
+            self.refresh()
             argv = self.args()
             argv.extend(['--option', 'Dpkg::Options::=--force-confold',
                          '-q', '-y'])
@@ -155,7 +725,8 @@ class Apt(PackageManager):
             argv.append('install')
             argv.extend(["'%s'" % p for p in packages])
     
-            self.module.run_command(' '.join(argv), True)
+            with Metrics.timer(self.module, 'packages'):
+                self.module.run_command(' '.join(argv), True)
             result = True
         return result
     
@@ -163,9 +734,10 @@ class Apt(PackageManager):
         packages = []
         if isinstance(pkgspec, str):
             pkgspec = [pkgspec]
-        for package in pkgspec:
-            name, version = self.package_split(package)
-            if self.installed(name):
+        pkgspec = [(package,) + self.package_split(package) for package in pkgspec]
+        statuses = self.statuses([name for package, name, version in pkgspec])
+        for package, name, version in pkgspec:
+            if self.status_installed(statuses.get(name), version):
                 packages.append(package)
     
         result = None
@@ -177,55 +749,286 @@ class Apt(PackageManager):
             argv.append('remove')
             argv.extend(["'%s'" % p for p in packages])
             
-            self.module.run_command(' '.join(argv), True)
+            with Metrics.timer(self.module, 'packages'):
+                self.module.run_command(' '.join(argv), True)
             result = True
         return result
     
-    # I'm not sure that this function works as intended...
-    def update(self):
+    def update(self, force=False):
+        # requests are coalesced and only acted on when the lists are needed
+        self._update = True
+        self._force = self._force or force
+    
+    def fresh(self, sources):
+        if sources == self._refreshed:
+            # nothing changed since the last refresh in this run
+            return True
+        if not self.cache_valid_time:
+            return False
+        mtime = self.lists_mtime()
+        if mtime is None:
+            return False
+        if [s for s in sources if s[1] > mtime]:
+            return False
+        return time.time() - mtime < self.cache_valid_time
+    
+    def refresh(self):
+        if not self._update:
+            return None
+        force = self._force
+        self._update = self._force = False
+        sources = self.sources_signature()
+        if not force and self.fresh(sources):
+            self._refreshed = sources
+            return None
         argv = self.args()
         argv.extend(['-q', '-y'])
         argv.append('update')
-        result = self.module.run_command(' '.join(argv), True)
-        return result
+        with Metrics.timer(self.module, 'apt_update'):
+            self.module.run_command(' '.join(argv), True)
+        self._refreshed = sources
+        return True
     
 #############################################################################
 #############################################################################
 
 class AptKey(object):
     CMD = 'apt-key'
-    PATH = '/usr/bin'
+    KEYRING_TEMPLATE = 'ansible-java-%s.gpg'
+    ARMOR_PATTERN = r'-----BEGIN PGP PUBLIC KEY BLOCK-----\r?\n(?:[^\r\n]+\r?\n)*\r?\n(.*?)\r?\n(?:=.{4}\r?\n)?-----END PGP PUBLIC KEY BLOCK-----'
+    KEY_TAGS = (6, 14) # public key, public subkey
+    
+    _signature = None
+    _index = None
+    
+    @classmethod
+    def dearmor(cls, data):
+        m = re.search(cls.ARMOR_PATTERN, data, re.DOTALL)
+        if m is None:
+            return data
+        return base64.b64decode(''.join(m.group(1).split()))
+    
+    @classmethod
+    def packets(cls, data):
+        i = 0
+        while i < len(data):
+            header = ord(data[i:i+1])
+            if not header & 0x80:
+                raise ValueError('Invalid OpenPGP packet header at %d' % i)
+            if header & 0x40:
+                tag = header & 0x3f
+                first = ord(data[i+1:i+2])
+                if first < 192:
+                    length, i = first, i + 2
+                elif first < 224:
+                    length = ((first - 192) << 8) + ord(data[i+2:i+3]) + 192
+                    i += 3
+                elif first == 255:
+                    length = struct.unpack('>I', data[i+2:i+6])[0]
+                    i += 6
+                else:
+                    raise ValueError('Partial OpenPGP packet at %d' % i)
+            else:
+                tag = (header >> 2) & 0x0f
+                size = (1, 2, 4, None)[header & 0x03]
+                if size is None:
+                    length, i = len(data) - i - 1, i + 1
+                else:
+                    length = struct.unpack('>' + {1: 'B', 2: 'H', 4: 'I'}[size], data[i+1:i+1+size])[0]
+                    i += 1 + size
+            yield tag, data[i:i+length]
+            i += length
+    
+    @classmethod
+    def fingerprints(cls, data):
+        fingerprints = []
+        for tag, body in cls.packets(cls.dearmor(data)):
+            if tag in cls.KEY_TAGS and body[:1] == b'\x04':
+                h = hashlib.sha1(b'\x99' + struct.pack('>H', len(body)) + body)
+                fingerprints.append(h.hexdigest().upper())
+        return fingerprints
+    
+    @classmethod
+    def keyrings(cls, distro):
+        keyrings = [distro.APT_KEYRING]
+        if os.path.isdir(distro.APT_KEYRING_DIR):
+            keyrings.extend([os.path.join(distro.APT_KEYRING_DIR, f)
+                             for f in sorted(os.listdir(distro.APT_KEYRING_DIR))
+                             if f.endswith('.gpg') or f.endswith('.asc')])
+        return [k for k in keyrings if os.path.isfile(k)]
+    
+    @classmethod
+    def index(cls, distro):
+        # maps fingerprints and their long and short key ids to keyrings
+        signature = tuple([(k, os.stat(k).st_mtime, os.stat(k).st_size) for k in cls.keyrings(distro)])
+        if signature != cls._signature:
+            index = {}
+            for keyring, mtime, size in signature:
+                with open(keyring, 'rb') as f:
+                    data = f.read()
+                try:
+                    fingerprints = cls.fingerprints(data)
+                except (ValueError, TypeError, struct.error):
+                    continue
+                for fingerprint in fingerprints:
+                    for key in (fingerprint, fingerprint[-16:], fingerprint[-8:]):
+                        index.setdefault(key, set()).add(keyring)
+            cls._index = index
+            cls._signature = signature
+        return cls._index
+    
+    @staticmethod
+    def normalize(key):
+        key = ''.join(key.split()).upper()
+        if key.startswith('0X'):
+            key = key[2:]
+        return key
     
     @classmethod
-    def installed(cls, module, key):
-        args = "%s list | grep '%s'" % (os.path.join(cls.PATH, cls.CMD), key)
-        result = module.run_command(args)
-        return len(result[1])
+    def installed(cls, module, distro, key):
+        return len(cls.index(distro).get(cls.normalize(key), ())) > 0
     
     @classmethod
-    def install(cls, module, key):
-        if cls.installed(module, key):
+    def install(cls, module, distro, key, keyfile=None):
+        if cls.installed(module, distro, key):
             return False
-        argv = [os.path.join(cls.PATH, cls.CMD), 'adv',
+        if keyfile:
+            # import offline, as a keyring of its own
+            with open(keyfile, 'rb') as f:
+                data = f.read()
+            fingerprints = cls.fingerprints(data)
+            if not [fp for fp in fingerprints if fp.endswith(cls.normalize(key))]:
+                raise ValueError('Key %s not found in %s' % (key, keyfile))
+            path = os.path.join(distro.APT_KEYRING_DIR, cls.KEYRING_TEMPLATE % cls.normalize(key))
+            with open(path, 'wb') as f:
+                f.write(cls.dearmor(data))
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            return True
+        argv = [os.path.join(distro.BIN_DIR, cls.CMD), 'adv',
                 '--keyserver', 'keys.gnupg.net', '--recv-keys', key]
         module.run_command(argv, True)
         return True
     
     @classmethod
-    def uninstall(cls, module, key):
-        if not cls.installed(module, key):
+    def uninstall(cls, module, distro, key):
+        if not cls.installed(module, distro, key):
             return False
-        argv = [os.path.join(cls.PATH, cls.CMD), 'del', key]
-        module.run_command(argv, True)
+        path = os.path.join(distro.APT_KEYRING_DIR, cls.KEYRING_TEMPLATE % cls.normalize(key))
+        keyrings = cls.index(distro)[cls.normalize(key)]
+        if path in keyrings:
+            os.remove(path)
+        if keyrings - set([path]):
+            argv = [os.path.join(distro.BIN_DIR, cls.CMD), 'del', key]
+            module.run_command(argv, True)
         return True
         
 #############################################################################
 #############################################################################
 
+class AptSources(object):
+    """Index of the entries in the apt sources files.
+    
+    The index is parsed on first use and rebuilt only when the files
+    change on disk.
+    """
+    
+    PPA_SERVER = 'http://ppa.launchpad.net/'
+    
+    @staticmethod
+    def normalize(line):
+        line = line.split('#', 1)[0]
+        return ' '.join(line.split())
+    
+    def __init__(self, path, dirname):
+        self.path = path
+        self.dirname = dirname
+        self._signature = None
+        self._lines = None
+        self._ppas = None
+    
+    def files(self):
+        files = [self.path]
+        if os.path.isdir(self.dirname):
+            files.extend([os.path.join(self.dirname, f) for f in sorted(os.listdir(self.dirname))
+                          if f.endswith('.list')])
+        return [f for f in files if os.path.isfile(f)]
+    
+    def signature(self):
+        signature = []
+        for path in self.files():
+            st = os.stat(path)
+            signature.append((path, st.st_mtime, st.st_size))
+        return tuple(signature)
+    
+    def index(self):
+        signature = self.signature()
+        if signature != self._signature:
+            self._lines = {}
+            self._ppas = {}
+            for path, mtime, size in signature:
+                with open(path, 'r') as f:
+                    for line in f:
+                        line = self.normalize(line)
+                        if not line:
+                            continue
+                        self._lines.setdefault(line, set()).add(path)
+                        fields = line.split()
+                        if len(fields) > 1 and fields[1].startswith(self.PPA_SERVER):
+                            ppa = '/'.join(fields[1][len(self.PPA_SERVER):].split('/')[:2])
+                            self._ppas.setdefault(ppa, set()).add(path)
+            self._signature = signature
+        return self._lines, self._ppas
+    
+    def lookup(self, repo):
+        # files that configure repo
+        lines, ppas = self.index()
+        if repo.split()[0] in ('deb', 'deb-src'):
+            return lines.get(self.normalize(repo), set())
+        elif repo.startswith('ppa:'):
+            return ppas.get(repo[4:], set())
+        else:
+            raise NotImplementedError(repo)
+    
+    def __contains__(self, repo):
+        return len(self.lookup(repo)) > 0
+    
+    def list_file(self, repo):
+        # named like add-apt-repository does
+        uri = repo.split()[1]
+        name = re.sub(r'[^a-zA-Z0-9_-]+', '_', uri.split('://', 1)[-1]).strip('_')
+        return os.path.join(self.dirname, name + '.list')
+    
+    def add(self, repo):
+        path = self.list_file(repo)
+        with open(path, 'a') as f:
+            f.write(self.normalize(repo) + '\n')
+        return path
+    
+    def remove(self, repo):
+        is_ppa = repo.startswith('ppa:')
+        for path in self.lookup(repo):
+            lines = []
+            with open(path, 'r') as f:
+                for line in f:
+                    fields = self.normalize(line).split()
+                    if is_ppa:
+                        match = len(fields) > 1 and fields[1].startswith(self.PPA_SERVER + repo[4:] + '/')
+                    else:
+                        match = ' '.join(fields) == self.normalize(repo)
+                    if not match:
+                        lines.append(line)
+            if path != self.path and not [l for l in lines if self.normalize(l)]:
+                os.remove(path)
+            else:
+                with open(path, 'w') as f:
+                    f.writelines(lines)
+
+#############################################################################
+#############################################################################
+
 class AptRepository(object):
     PACKAGE = 'python-software-properties'
     CMD = 'add-apt-repository'
-    PPA_SERVER = 'http://ppa.launchpad.net/'
     
     @classmethod
     def args(cls):
@@ -234,70 +1037,1015 @@ class AptRepository(object):
             args.append('-y')
         return args
     
-    def __init__(self, module):
+    def __init__(self, module, distro, apt=None, sources=None):
         self.module = module
-        self.apt = Apt(self.module)
+        self.apt = Apt(self.module, distro) if apt is None else apt
+        self.sources = AptSources(distro.APT_SOURCES_FILE, distro.APT_SOURCES_DIR) \
+            if sources is None else sources
+        self.write_sources = module.params.get('write_sources', True)
+    
+    def writable(self, repo):
+        # PPAs need their signing key, which add-apt-repository imports
+        return self.write_sources and repo.split()[0] in ('deb', 'deb-src')
+    
+    def run(self, argv):
+        # the lists may be empty on a fresh host; if the package is there
+        # already, this update is coalesced with the one after argv
+        self.apt.update()
         self.apt.install(self.PACKAGE)
+        self.module.run_command(argv, True)
     
     def installed(self, repo):
-        args = "grep -E -v '^#|^ *$' /etc/apt/sources.list /etc/apt/sources.list.d/*.list"
-        result = self.module.run_command(args)
-        for output in result[1].splitlines():
-            filename, line = output.split(':', 1)
-            if repo.split()[0] in ('deb', 'deb-src'):
-                if line == repo:
-                    return True
-            elif repo.startswith('ppa:'):
-                url = self.PPA_SERVER + repo[4:] + '/'
-                if line.split()[1].startswith(url):
-                    return True
-            else:
-                raise NotImplementedError(repo)
-        return False
+        return repo in self.sources
     
     def install(self, repo):
         if self.installed(repo):
             return None
-        argv = self.args()
-        argv.append(repo)
-        self.module.run_command(argv, True)
+        if self.writable(repo):
+            self.sources.add(repo)
+        else:
+            argv = self.args()
+            argv.append(repo)
+            self.run(argv)
         self.apt.update()
         return True
     
     def uninstall(self, repo):
         if not self.installed(repo):
             return None
-        argv = self.args()
-        argv.append('--remove')
-        argv.append(repo)
-        self.module.run_command(argv, True)
+        if self.write_sources:
+            self.sources.remove(repo)
+        else:
+            argv = self.args()
+            argv.append('--remove')
+            argv.append(repo)
+            self.run(argv)
         self.apt.update()
         return True
 
 #############################################################################
 #############################################################################
 
-class JavaVersion(namedtuple('JavaVersion', 'major, minor, release, build')):
-    MAJOR_PATTERN = r'(?P<major>[0-7])'
-    MINOR_PATTERN = r'(?P<minor>\d+)'
-    RELEASE_PATTERN = r'(?P<release>\d+)'
-    BUILD_PATTERN = r'(?:-b(?P<build>\d+))'
-    VERSION_PATTERN = r'^(?:1\.)?%s(?:\.%s(?:_%s%s?)?)?$' \
-        % (MAJOR_PATTERN, MINOR_PATTERN, RELEASE_PATTERN, BUILD_PATTERN)
-    UPDATE_PATTERN = r'^%s(?:u%s%s?)?$' \
-        % (MAJOR_PATTERN, RELEASE_PATTERN, BUILD_PATTERN)
+class ArtifactCache(object):
+    """Content-addressed store of downloaded packages.
     
-    VERSION_TEMPLATE = r'1.%(major)d.%(minor)d_%(release)d'
-    UPDATE_TEMPLATE = r'%(major)du%(release)d'
-    BUILD_TEMPLATE = UPDATE_TEMPLATE + '-b%(build)02d'
+    Objects are kept under their sha256 digest and an index maps
+    (version, kind, arch, format) keys to digests. Least recently used
+    objects are evicted once the store exceeds its size limit.
+    """
+    
+    INDEX_FILE = 'index.json'
+    OBJECTS_DIR = 'objects'
+    STAGING_DIR = 'staging'
+    BLOCK_SIZE = 1 << 20
+    
+    # serializes index updates of concurrent fetches
+    LOCK = threading.RLock()
     
     @classmethod
-    def from_string(cls, text):
-        if not text:
-            return None
-
-        for pattern in (cls.VERSION_PATTERN, cls.UPDATE_PATTERN):
-            m = re.match(pattern, text)
+    def digest(cls, path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(cls.BLOCK_SIZE)
+                if not block:
+                    break
+                h.update(block)
+        return h.hexdigest()
+    
+    @staticmethod
+    def key(version, kind, arch, fmt):
+        return '/'.join((version.build_string(), kind, arch, fmt))
+    
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        self.staging = os.path.join(root, self.STAGING_DIR)
+        for path in (self.root, self.staging):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.index = self.load()
+    
+    def load(self):
+        path = os.path.join(self.root, self.INDEX_FILE)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {'artifacts': {}, 'objects': {}}
+    
+    def save(self):
+        AtomicFile.write_json(os.path.join(self.root, self.INDEX_FILE), self.index, AtomicFile.PRIVATE)
+    
+    def path(self, digest, filename):
+        return os.path.join(self.root, self.OBJECTS_DIR, digest, filename)
+    
+    def lookup(self, key):
+        with self.LOCK:
+            self.index = self.load()
+            return self._lookup(key)
+    
+    def _lookup(self, key):
+        artifact = self.index['artifacts'].get(key)
+        if artifact is None or artifact['digest'] not in self.index['objects']:
+            return None
+        digest = artifact['digest']
+        entry = self.index['objects'][digest]
+        path = self.path(digest, artifact['filename'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            self.remove(digest)
+            self.save()
+            return None
+        entry['atime'] = time.time()
+        self.save()
+        return path
+    
+    def known_digest(self, key):
+        with self.LOCK:
+            self.index = self.load()
+            artifact = self.index['artifacts'].get(key)
+        return artifact['digest'] if artifact is not None else None
+    
+    def record(self, key, digest, filename):
+        # remember the digest of an artifact that was not stored
+        with self.LOCK:
+            self.index = self.load()
+            self.index['artifacts'][key] = {'digest': digest, 'filename': filename}
+            self.save()
+    
+    def add(self, key, source):
+        # takes ownership of source
+        digest = self.digest(source)
+        with self.LOCK:
+            self.index = self.load()
+            return self._add(key, source, digest)
+    
+    def _add(self, key, source, digest):
+        filename = os.path.basename(source)
+        path = self.path(digest, filename)
+        objdir = os.path.dirname(path)
+        if not os.path.isdir(objdir):
+            os.makedirs(objdir)
+        if os.path.isfile(path):
+            os.remove(source)
+        else:
+            os.rename(source, path)
+        entry = self.index['objects'].setdefault(digest, {})
+        entry['size'] = os.path.getsize(path)
+        entry['atime'] = time.time()
+        self.index['artifacts'][key] = {'digest': digest, 'filename': filename}
+        self.evict(digest)
+        self.save()
+        return path
+    
+    def remove(self, digest):
+        objdir = os.path.join(self.root, self.OBJECTS_DIR, digest)
+        if os.path.isdir(objdir):
+            shutil.rmtree(objdir)
+        del self.index['objects'][digest]
+        for key, artifact in list(self.index['artifacts'].items()):
+            if artifact['digest'] == digest:
+                del self.index['artifacts'][key]
+    
+    def evict(self, keep=None):
+        if not self.max_size:
+            return
+        objects = self.index['objects']
+        size = sum([entry['size'] for entry in objects.values()])
+        lru = sorted(objects, key=lambda digest: objects[digest]['atime'])
+        for digest in lru:
+            if size <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            size -= objects[digest]['size']
+            self.remove(digest)
+
+#############################################################################
+#############################################################################
+
+class Deduplicator(object):
+    """Replaces identical files across Java homes with links to one copy.
+    
+    Files are hard linked, or reflinked where the filesystem supports
+    it, only when their content, mode and owner match. Configuration
+    that tools rewrite in place is never hard linked. The digests of
+    each home are kept in an index file, so only homes not seen before
+    are hashed.
+    """
+    
+    MODES = ('hardlink', 'reflink',)
+    
+    # e.g. cacerts, which keytool rewrites in place, through any hard link
+    MUTABLE = ('lib/security/*', 'jre/lib/security/*', '*.properties', '*.cfg',)
+    
+    # from linux/fs.h
+    FICLONE = 0x40049409
+    
+    def __init__(self, path, mode='hardlink', workers=1):
+        if mode not in self.MODES:
+            raise ValueError(mode)
+        self.path = path
+        self.mode = mode
+        self.workers = max(workers, 1)
+    
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'homes': {}}
+    
+    def save(self, index):
+        AtomicFile.write(self.path, json.dumps(index), AtomicFile.PRIVATE)
+    
+    @staticmethod
+    def identity(home):
+        # changes when the home is replaced or its top level is touched
+        st = os.stat(home)
+        return [st.st_ino, st.st_ctime]
+    
+    def pending(self, homes):
+        known = self.load()['homes']
+        return bool([h for h in homes if h not in known or known[h]['identity'] != self.identity(h)])
+    
+    @classmethod
+    def mutable(cls, rel):
+        return bool([p for p in cls.MUTABLE if fnmatch.fnmatch(rel, p)])
+    
+    def shareable(self, rel):
+        # a clone is copied on write, so only hard links are held back
+        return self.mode != 'hardlink' or not self.mutable(rel)
+    
+    @staticmethod
+    def files(home):
+        for dirpath, dirnames, filenames in os.walk(home):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                    yield path, st
+    
+    def link(self, source, path):
+        tmp = os.path.join(os.path.dirname(path), '.%s.dedup' % os.path.basename(path))
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(source, tmp)
+        os.rename(tmp, path)
+        return True
+    
+    @classmethod
+    def clone(cls, source, path, st):
+        # a copy sharing the extents of source
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(path))
+        try:
+            with open(source, 'rb') as f:
+                fcntl.ioctl(fd, cls.FICLONE, f.fileno())
+        except (IOError, OSError) as e:
+            os.close(fd)
+            os.remove(tmp)
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                return False
+            raise
+        os.close(fd)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, path)
+        return True
+    
+    def run(self, homes):
+        start = time.time()
+        index = self.load()
+        homes = sorted(homes)
+        known = dict([(h, e) for h, e in index['homes'].items()
+                      if h in homes and os.path.isdir(h) and e['identity'] == self.identity(h)])
+        new = [h for h in homes if h not in known]
+        
+        # the first copy of each file in a known home is the one kept
+        copies = {}
+        for home in sorted(known):
+            for rel, (size, digest, mode, uid, gid) in sorted(known[home]['files'].items()):
+                if not self.shareable(rel):
+                    continue
+                copies.setdefault((digest, size, mode, uid, gid), os.path.join(home, rel))
+        
+        def hash_file(entry):
+            return ArtifactCache.digest(entry[0])
+        
+        linked = reclaimed = hashed = 0
+        pool = ThreadPool(self.workers)
+        try:
+            for home in new:
+                entries = list(self.files(home))
+                digests = pool.map(hash_file, entries)
+                files = {}
+                for (path, st), digest in zip(entries, digests):
+                    hashed += st.st_size
+                    key = (digest, st.st_size, st.st_mode, st.st_uid, st.st_gid)
+                    rel = os.path.relpath(path, home)
+                    files[rel] = [st.st_size, digest, st.st_mode, st.st_uid, st.st_gid]
+                    if not self.shareable(rel):
+                        continue
+                    source = copies.setdefault(key, path)
+                    if source == path:
+                        continue
+                    try:
+                        sst = os.lstat(source)
+                    except OSError:
+                        copies[key] = path
+                        continue
+                    if sst.st_ino == st.st_ino or sst.st_dev != st.st_dev \
+                            or not stat.S_ISREG(sst.st_mode) or sst.st_size != st.st_size:
+                        continue
+                    if self.mode == 'reflink':
+                        done = self.clone(source, path, st)
+                    else:
+                        done = self.link(source, path)
+                    if done:
+                        linked += 1
+                        # a file still linked elsewhere frees nothing
+                        if self.mode == 'reflink' or st.st_nlink == 1:
+                            reclaimed += st.st_size
+                known[home] = {'identity': self.identity(home), 'files': files}
+        finally:
+            pool.close()
+            pool.join()
+        
+        index['homes'] = known
+        self.save(index)
+        elapsed = time.time() - start
+        return {
+            'mode': self.mode,
+            'homes': len(new),
+            'hashed': hashed,
+            'files': linked,
+            'bytes': reclaimed,
+            'seconds': round(elapsed, 3),
+        }
+
+#############################################################################
+#############################################################################
+
+class ImageCache(object):
+    """Extracted homes kept outside JAVA_HOME, by the digest of their package.
+    
+    A home is materialized from its image as a farm of hard links, or of
+    reflinked or plain copies across filesystems, so that reinstalling a
+    package skips fetching and extracting it. Files that tools rewrite in
+    place, e.g. cacerts, are copied rather than linked, and images are
+    read-only: their directories and their own copies lose their write
+    bits, whose modes are kept next to the image and restored on the
+    homes materialized from it. The linked files are shared with homes,
+    so they are not to be modified in place either.
+    """
+    
+    IMAGES_DIR = 'images'
+    MODES_SUFFIX = '.modes'
+    
+    WRITE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    
+    def __init__(self, root):
+        self.root = os.path.join(root, self.IMAGES_DIR)
+    
+    def path(self, digest, name):
+        return os.path.join(self.root, digest, name)
+    
+    def lookup(self, digest, name):
+        path = self.path(digest, name)
+        return path if os.path.isdir(path) else None
+    
+    def homes(self):
+        # every image, e.g. to deduplicate with the homes
+        if not os.path.isdir(self.root):
+            return []
+        homes = []
+        for digest in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, digest)
+            if not digest.startswith('.') and os.path.isdir(path):
+                homes.extend([os.path.join(path, f) for f in sorted(os.listdir(path))
+                              if os.path.isdir(os.path.join(path, f))])
+        return homes
+    
+    def modes(self, digest, name):
+        try:
+            with open(self.path(digest, name) + self.MODES_SUFFIX, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+    
+    @staticmethod
+    def copy(source, dest, st, link=True):
+        # shares the inode where possible, then the extents, then copies;
+        # returns whether the inode is shared
+        if link:
+            try:
+                os.link(source, dest)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        if not Deduplicator.clone(source, dest, st):
+            shutil.copy2(source, dest)
+            os.chown(dest, st.st_uid, st.st_gid)
+        return False
+    
+    @classmethod
+    def farm(cls, source, dest, modes=None):
+        # returns the number of files and the copies among them, which
+        # get their modes from modes, if given, as directories do
+        modes = modes or {}
+        files = 0
+        dirs = []
+        copies = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            rel = os.path.normpath(os.path.relpath(dirpath, source))
+            target = os.path.normpath(os.path.join(dest, rel))
+            os.mkdir(target, stat.S_IRWXU)
+            dirs.append((dirpath, target, rel))
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif stat.S_ISREG(st.st_mode):
+                    relpath = os.path.normpath(os.path.join(rel, name))
+                    if not cls.copy(path, os.path.join(target, name), st, not Deduplicator.mutable(relpath)):
+                        if relpath in modes:
+                            os.chmod(os.path.join(target, name), modes[relpath])
+                        copies.append(relpath)
+                    files += 1
+        # directories last, deepest first, once nothing more is written to them
+        for path, target, rel in reversed(dirs):
+            st = os.stat(path)
+            os.chown(target, st.st_uid, st.st_gid)
+            os.chmod(target, modes.get(rel, stat.S_IMODE(st.st_mode)))
+            os.utime(target, (st.st_atime, st.st_mtime))
+        return files, copies
+    
+    @classmethod
+    def seal(cls, image, copies):
+        # drops the write bits of the directories and copies of an image,
+        # returning the modes they had
+        modes = {}
+        for rel in copies:
+            path = os.path.join(image, rel)
+            mode = stat.S_IMODE(os.lstat(path).st_mode)
+            modes[rel] = mode
+            os.chmod(path, mode & ~cls.WRITE)
+        for dirpath, dirnames, filenames in os.walk(image, topdown=False):
+            mode = stat.S_IMODE(os.lstat(dirpath).st_mode)
+            modes[os.path.normpath(os.path.relpath(dirpath, image))] = mode
+            os.chmod(dirpath, mode & ~cls.WRITE)
+        return modes
+    
+    def materialize(self, digest, dest):
+        # returns None if there is no image to materialize dest from
+        name = os.path.basename(dest)
+        image = self.lookup(digest, name)
+        if image is None:
+            return None
+        start = time.time()
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=os.path.dirname(dest))
+        try:
+            files, copies = self.farm(image, os.path.join(staging, name), self.modes(digest, name))
+            os.rename(os.path.join(staging, name), dest)
+        finally:
+            Trash.rmtree(staging)
+        return {
+            'image': image,
+            'dest': dest,
+            'files': files,
+            'seconds': round(time.time() - start, 3),
+        }
+    
+    def add(self, digest, home):
+        name = os.path.basename(home)
+        if self.lookup(digest, name) is not None:
+            return None
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        # the digest directory is staged whole, so an image is never
+        # visible before it is sealed and its modes are kept
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            image = os.path.join(staging, name)
+            files, copies = self.farm(home, image)
+            modes = self.seal(image, copies)
+            with open(image + self.MODES_SUFFIX, 'w') as f:
+                json.dump(modes, f)
+            os.chmod(staging, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+            path = os.path.join(self.root, digest)
+            if os.path.isdir(path):
+                # left without this image by an interrupted run
+                Trash.move(path)
+            os.rename(staging, path)
+        finally:
+            Trash.rmtree(staging)
+        return self.path(digest, name)
+    
+    def prune(self, digests):
+        # drops the images of packages no longer known
+        if not os.path.isdir(self.root):
+            return []
+        pruned = []
+        for digest in sorted(os.listdir(self.root)):
+            if not digest.startswith('.') and digest not in digests:
+                Trash.move(os.path.join(self.root, digest))
+                pruned.append(digest)
+        return pruned
+
+#############################################################################
+#############################################################################
+
+class Trash(object):
+    """Directories renamed aside, to be deleted off the critical path.
+    
+    A directory is renamed next to itself, which is atomic and costs the
+    same whatever its size, and swept later, by a detached process or by
+    a later run.
+    """
+    
+    PREFIX = '.ansible-java-trash-'
+    
+    @classmethod
+    def move(cls, path):
+        dirname, name = os.path.split(path.rstrip('/'))
+        trash = tempfile.mkdtemp(prefix=cls.PREFIX + name + '-', dir=dirname)
+        os.rename(path, os.path.join(trash, name))
+        return trash
+    
+    @staticmethod
+    def rmtree(path):
+        # images are read-only, which is not to keep them from being deleted
+        def unseal(func, failed, exc_info):
+            parent = os.path.dirname(failed)
+            try:
+                os.chmod(parent, stat.S_IMODE(os.lstat(parent).st_mode) | stat.S_IWUSR | stat.S_IXUSR)
+                func(failed)
+            except OSError:
+                pass
+        if os.path.lexists(path):
+            shutil.rmtree(path, onerror=unseal)
+    
+    @classmethod
+    def entries(cls, dirnames):
+        entries = []
+        for dirname in dirnames:
+            if os.path.isdir(dirname):
+                entries.extend([os.path.join(dirname, f) for f in sorted(os.listdir(dirname))
+                                if f.startswith(cls.PREFIX)])
+        return entries
+    
+    @classmethod
+    def sweep(cls, dirnames):
+        entries = cls.entries(dirnames)
+        for path in entries:
+            cls.rmtree(path)
+        return len(entries)
+    
+    @classmethod
+    def sweep_detached(cls, dirnames):
+        # sweeps in a grandchild in its own session, which nothing waits for
+        if not cls.entries(dirnames):
+            return False
+        try:
+            pid = os.fork()
+        except OSError:
+            return False
+        if pid:
+            os.waitpid(pid, 0)
+            return True
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, 1024)
+            cls.sweep(dirnames)
+        finally:
+            os._exit(0)
+
+#############################################################################
+#############################################################################
+
+class Downloader(object):
+    """Fetches a URL over concurrent HTTP Range requests.
+    
+    Completed segments are recorded next to the destination, so that an
+    interrupted download resumes where it left off. Servers that do not
+    honor ranges are read as a single stream.
+    """
+    
+    SEGMENT_SIZE = 8 << 20
+    BLOCK_SIZE = 1 << 16
+    CONTENT_RANGE_PATTERN = r'^bytes (\d+)-(\d+)/(\d+)$'
+    
+    def __init__(self, headers=None, connections=4, retries=5, timeout=60, backoff=1.0):
+        self.headers = dict(headers or {})
+        self.connections = max(connections, 1)
+        self.retries = max(retries, 1)
+        self.timeout = timeout
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.transferred = 0
+    
+    def open(self, url, start=None, end=None):
+        request = urllib2.Request(url, headers=self.headers)
+        if start is not None:
+            request.add_header('Range', 'bytes=%d-%d' % (start, end))
+        return urllib2.urlopen(request, timeout=self.timeout)
+    
+    def retry(self, func, *args):
+        delay = self.backoff
+        for attempt in range(self.retries):
+            try:
+                return func(*args)
+            except (IOError, httplib.HTTPException) as e:
+                if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                    raise
+                if attempt + 1 == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+    
+    def copy(self, response, f, length=None):
+        copied = 0
+        while length is None or copied < length:
+            size = self.BLOCK_SIZE
+            if length is not None:
+                size = min(size, length - copied)
+            block = response.read(size)
+            if not block:
+                break
+            f.write(block)
+            copied += len(block)
+            with self.lock:
+                self.transferred += len(block)
+        if length is not None and copied != length:
+            raise IOError('Short read: %d of %d bytes' % (copied, length))
+        return copied
+    
+    def probe(self, url):
+        # returns the final url, and the size if ranges are supported
+        response = self.open(url, 0, 0)
+        try:
+            content_range = response.info().getheader('Content-Range') or ''
+            m = re.match(self.CONTENT_RANGE_PATTERN, content_range)
+            if response.getcode() == 206 and m is not None:
+                return response.geturl(), int(m.group(3))
+            return response.geturl(), None
+        finally:
+            response.close()
+    
+    def preallocate(self, dest, size):
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+    
+    def fetch_stream(self, url, dest, size=None):
+        response = self.open(url)
+        try:
+            if size is None:
+                with open(dest, 'wb') as f:
+                    self.copy(response, f)
+            else:
+                self.preallocate(dest, size)
+                with open(dest, 'r+b') as f:
+                    self.copy(response, f, size)
+                    if response.read(1):
+                        raise IOError('Response is longer than %d bytes' % size)
+        finally:
+            response.close()
+    
+    def fetch_range(self, url, dest, start, end):
+        response = self.open(url, start, end)
+        try:
+            content_range = response.info().getheader('Content-Range') or ''
+            m = re.match(self.CONTENT_RANGE_PATTERN, content_range)
+            if response.getcode() != 206 or m is None or int(m.group(1)) != start:
+                raise IOError('Unexpected response to range %d-%d: %s %s' \
+                              % (start, end, response.getcode(), content_range))
+            with open(dest, 'r+b') as f:
+                f.seek(start)
+                self.copy(response, f, end - start + 1)
+        finally:
+            response.close()
+    
+    def fetch_segments(self, url, dest, size):
+        state_file = dest + '.segments'
+        state = {'size': size, 'done': []}
+        if os.path.exists(state_file):
+            if os.path.exists(dest):
+                with open(state_file, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('size') == size:
+                    state = saved
+        elif os.path.exists(dest) and os.path.getsize(dest) == size:
+            # completed by an earlier run
+            return 0
+        
+        def save():
+            with open(state_file, 'w') as f:
+                json.dump(state, f)
+        
+        save()
+        self.preallocate(dest, size)
+        
+        def fetch(start):
+            end = min(start + self.SEGMENT_SIZE, size) - 1
+            self.retry(self.fetch_range, url, dest, start, end)
+            with self.lock:
+                state['done'].append(start)
+                save()
+        
+        pending = [start for start in range(0, size, self.SEGMENT_SIZE)
+                   if start not in state['done']]
+        if pending:
+            pool = ThreadPool(min(self.connections, len(pending)))
+            try:
+                pool.map(fetch, pending)
+            finally:
+                pool.close()
+                pool.join()
+        os.remove(state_file)
+        return len(pending)
+    
+    def download(self, url, dest, size=None):
+        # size, if known in advance, is checked against the server
+        start = time.time()
+        self.transferred = 0
+        url, length = self.retry(self.probe, url)
+        if length is None:
+            self.retry(self.fetch_stream, url, dest, size)
+            segments = 1
+        else:
+            if size is not None and length != size:
+                raise IOError('Expected %d bytes, server has %d' % (size, length))
+            segments = self.fetch_segments(url, dest, length)
+        elapsed = time.time() - start
+        return {
+            'url': url,
+            'dest': dest,
+            'size': os.path.getsize(dest),
+            'bytes': self.transferred,
+            'segments': segments,
+            'ranged': length is not None,
+            'seconds': round(elapsed, 3),
+            'bytes_per_second': int(self.transferred / elapsed) if elapsed > 0 else 0,
+        }
+
+#############################################################################
+#############################################################################
+
+class HashingReader(object):
+    """File-like wrapper that hashes everything read through it."""
+    
+    BLOCK_SIZE = 1 << 20
+    
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+    
+    def read(self, size=-1):
+        if size < 0:
+            data = self.fileobj.read()
+        else:
+            data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+    
+    def drain(self):
+        while self.read(self.BLOCK_SIZE):
+            pass
+    
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+#############################################################################
+#############################################################################
+
+class GzipReader(object):
+    """File-like view of a gzip stream decompressed by a background thread."""
+    
+    BLOCK_SIZE = 1 << 20
+    QUEUE_SIZE = 16
+    
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        # decompressed blocks, read from offset in the first one
+        self.blocks = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.eof = False
+        self.error = None
+        self.thread = threading.Thread(target=self.decompress)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def decompress(self):
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                block = self.fileobj.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                while block:
+                    self.queue.put(decompressor.decompress(block))
+                    # concatenated gzip members
+                    block = decompressor.unused_data
+                    if block:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.queue.put(decompressor.flush())
+        except Exception as e:
+            self.error = e
+        self.queue.put(None)
+    
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self.buffered < size):
+            block = self.queue.get()
+            if block is None:
+                self.eof = True
+                if self.error is not None:
+                    raise IOError('Decompression failed: %s' % self.error)
+            elif block:
+                self.blocks.append(block)
+                self.buffered += len(block)
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+        # only the bytes returned are copied, never the rest of a block
+        parts = []
+        needed = size
+        while needed:
+            block = self.blocks[0]
+            part = block[self.offset:self.offset + needed]
+            parts.append(part)
+            needed -= len(part)
+            self.offset += len(part)
+            if self.offset == len(block):
+                self.blocks.popleft()
+                self.offset = 0
+        self.buffered -= size
+        return b''.join(parts)
+
+#############################################################################
+#############################################################################
+
+class TarExtractor(object):
+    """Unpacks a tar stream, while a GzipReader decompresses ahead of it.
+    
+    Members are written in order, straight from the stream, so no file
+    is held in memory. Threads writing files were measured slower than
+    tar, as tarfile holds the interpreter lock, so there are none.
+    Nothing is written through a symlink of the archive. Hard links and
+    directory metadata are applied once every file is in place. The
+    size of every file in the archive can be collected into a manifest,
+    which the extracted tree is validated against.
+    """
+    
+    @staticmethod
+    def member_path(destdir, member, safe=None):
+        # safe, if given, holds the directories known to be real ones
+        path = os.path.normpath(os.path.join(destdir, member.name))
+        if os.path.isabs(member.name) or not path.startswith(os.path.join(destdir, '')):
+            raise RuntimeError('Unsafe archive member: %s' % member.name)
+        if safe is not None:
+            parent = os.path.dirname(path)
+            checked = []
+            while parent not in safe and parent != destdir:
+                if os.path.islink(parent):
+                    raise RuntimeError('Archive member %s is under a symlink' % member.name)
+                checked.append(parent)
+                parent = os.path.dirname(parent)
+            safe.update(checked)
+        return path
+    
+    @staticmethod
+    def write(path, data, member):
+        # data is either the contents or a file to copy them from
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, 'wb') as f:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, f, 1 << 20)
+            else:
+                f.write(data)
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+    
+    @staticmethod
+    def validate(destdir, manifest):
+        # the files on disk are exactly those of the archive, at full size
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(destdir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    found[os.path.relpath(path, destdir)] = st.st_size
+        if found != manifest:
+            missing = sorted([n for n in manifest if found.get(n) != manifest[n]])
+            raise RuntimeError('Incomplete extraction in %s: %d of %d files, %s' \
+                               % (destdir, len(found), len(manifest), ', '.join(missing[:5])))
+        return len(found)
+    
+    def extract(self, fileobj, destdir, compressed=True, manifest=None):
+        start = time.time()
+        if compressed:
+            fileobj = GzipReader(fileobj)
+        archive = tarfile.open(fileobj=fileobj, mode='r|')
+        safe = set()
+        directories = []
+        links = []
+        files = 0
+        size = 0
+        
+        for member in archive:
+            path = self.member_path(destdir, member, safe)
+            if os.path.islink(path) and not member.issym():
+                raise RuntimeError('Archive member %s replaces a symlink' % member.name)
+            if member.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, member))
+                continue
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if member.isfile():
+                self.write(path, archive.extractfile(member), member)
+                size += member.size
+                if manifest is not None:
+                    manifest[os.path.relpath(path, destdir)] = member.size
+            elif member.issym():
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.symlink(member.linkname, path)
+                safe.discard(path)
+            elif member.islnk():
+                links.append((path, member))
+            else:
+                continue
+            files += 1
+        # consume trailing padding so the whole stream is read
+        while fileobj.read(tarfile.RECORDSIZE):
+            pass
+        
+        for path, member in links:
+            # checked again, as later members may have added symlinks
+            path = self.member_path(destdir, member, set())
+            target = self.member_path(destdir, tarfile.TarInfo(member.linkname), set())
+            if os.path.islink(path) or os.path.islink(target):
+                raise RuntimeError('Archive member %s links through a symlink' % member.name)
+            if os.path.lexists(path):
+                os.remove(path)
+            os.link(target, path)
+            if manifest is not None:
+                manifest[os.path.relpath(path, destdir)] = os.path.getsize(target)
+        for path, member in reversed(directories):
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+        
+        elapsed = time.time() - start
+        return {
+            'dest': destdir,
+            'files': files,
+            'bytes': size,
+            'seconds': round(elapsed, 3),
+            'bytes_per_second': int(size / elapsed) if elapsed > 0 else 0,
+        }
+
+#############################################################################
+#############################################################################
+
+class JavaVersion(namedtuple('JavaVersion', 'major, minor, release, build')):
+    MAJOR_PATTERN = r'(?P<major>[0-7])'
+    MINOR_PATTERN = r'(?P<minor>\d+)'
+    RELEASE_PATTERN = r'(?P<release>\d+)'
+    BUILD_PATTERN = r'(?:-b(?P<build>\d+))'
+    VERSION_PATTERN = r'^(?:1\.)?%s(?:\.%s(?:_%s%s?)?)?$' \
+        % (MAJOR_PATTERN, MINOR_PATTERN, RELEASE_PATTERN, BUILD_PATTERN)
+    UPDATE_PATTERN = r'^%s(?:u%s%s?)?$' \
+        % (MAJOR_PATTERN, RELEASE_PATTERN, BUILD_PATTERN)
+    
+    VERSION_TEMPLATE = r'1.%(major)d.%(minor)d_%(release)d'
+    UPDATE_TEMPLATE = r'%(major)du%(release)d'
+    BUILD_TEMPLATE = UPDATE_TEMPLATE + '-b%(build)02d'
+    
+    @classmethod
+    def from_string(cls, text):
+        if not text:
+            return None
+
+        for pattern in (cls.VERSION_PATTERN, cls.UPDATE_PATTERN):
+            m = re.match(pattern, text)
             if m is not None:
                 break
         else:
@@ -323,125 +2071,816 @@ class JavaVersion(namedtuple('JavaVersion', 'major, minor, release, build')):
 #############################################################################
 #############################################################################
 
+class ReleaseCatalog(object):
+    """Index of the Java builds available for installation.
+    
+    Each entry gives the version, build, arch, kind, format, url, size
+    and sha256 of one package. Entries are indexed by release and by
+    major version, with the newest build first.
+    """
+    
+    FIELDS = ('version', 'build', 'arch', 'kind', 'format', 'url', 'size', 'sha256',)
+    
+    @classmethod
+    def load(cls, source):
+        if source.startswith('/'):
+            with open(source, 'r') as f:
+                data = json.load(f)
+        else:
+            response = urllib2.urlopen(source)
+            try:
+                data = json.load(response)
+            finally:
+                response.close()
+        if isinstance(data, dict):
+            data = data['releases']
+        return cls(data)
+    
+    @staticmethod
+    def entry_version(entry):
+        # None for versions this module cannot install, e.g. 8u20
+        version = JavaVersion.from_string(entry['version'])
+        if version is None:
+            return None
+        return version._replace(build=int(entry.get('build') or version.build))
+    
+    def __init__(self, entries):
+        self.entries = []
+        self.latest = {}
+        self.releases = {}
+        for entry in entries:
+            entry = dict([(k, entry.get(k)) for k in self.FIELDS])
+            entry['version'] = self.entry_version(entry)
+            if entry['version'] is None:
+                continue
+            self.entries.append(entry)
+        for entry in sorted(self.entries, key=lambda e: e['version'], reverse=True):
+            version = entry['version']
+            key = (entry['kind'], entry['arch'], entry['format'])
+            self.latest.setdefault((version.major,) + key, entry)
+            self.releases.setdefault((version.major, version.minor, version.release) + key, []).append(entry)
+    
+    def majors(self):
+        return sorted(set([e['version'].major for e in self.entries]))
+    
+    def find(self, version, kind, arch, fmt):
+        # the newest build matching as much of version as is given
+        key = (kind, arch, fmt)
+        if not version.release:
+            return self.latest.get((version.major,) + key)
+        for entry in self.releases.get((version.major, version.minor, version.release) + key, []):
+            if not version.build or entry['version'].build == version.build:
+                return entry
+        return None
+
+#############################################################################
+#############################################################################
+
+class MirrorCatalog(ReleaseCatalog):
+    """Release catalog of the packages in a local mirror.
+    
+    A mirror is a directory of packages under their Oracle file names, or
+    an index file listing such paths or URLs, one per line. A scan is
+    reused until the mtime of the directory or index file changes.
+    """
+    
+    FORMATS = {'.tar.gz': 'tar.gz', '.rpm': 'rpm',}
+    
+    _scans = {}
+    
+    @classmethod
+    def parse(cls, location):
+        # an entry for a package file name, or None for anything else
+        m = re.match(Java.ORACLE_FILE_PATTERN, location.rsplit('/', 1)[-1])
+        if m is None:
+            return None
+        kind, update, arch, suffix = m.groups()
+        if kind not in ('jre', 'jdk',) or suffix not in cls.FORMATS:
+            return None
+        version = JavaVersion.from_string(update)
+        if version is None:
+            return None
+        return {
+            'version': update,
+            'build': version.build,
+            'arch': arch,
+            'kind': kind,
+            'format': cls.FORMATS[suffix],
+            'url': location,
+        }
+    
+    @classmethod
+    def scan(cls, path):
+        mtime = os.stat(path).st_mtime
+        scan = cls._scans.get(path)
+        if scan is not None and scan[0] == mtime:
+            return scan[1]
+        if os.path.isdir(path):
+            locations = [os.path.join(path, f) for f in os.listdir(path)]
+        else:
+            with open(path, 'r') as f:
+                locations = [l.strip() for l in f if l.strip() and not l.strip().startswith('#')]
+            dirname = os.path.dirname(path)
+            locations = [l if '://' in l else os.path.join(dirname, l) for l in locations]
+        entries = [e for e in [cls.parse(l) for l in locations] if e is not None]
+        mirror = cls(entries)
+        cls._scans[path] = (mtime, mirror)
+        return mirror
+    
+    def find(self, version, kind, arch, fmt):
+        # file names carry no build number
+        return super(MirrorCatalog, self).find(version._replace(build=0), kind, arch, fmt)
+
+#############################################################################
+#############################################################################
+
+class Alternatives(object):
+    """Link groups of the alternatives system, read from its admin directory.
+    
+    The registered state is compared with the requested one, so that
+    commands are only run for groups that differ.
+    """
+    
+    @staticmethod
+    def parse(text):
+        lines = text.split('\n')
+        group = {
+            'mode': lines[0].strip(),
+            'link': lines[1].strip(),
+            'slaves': [],
+            'alternatives': {},
+        }
+        i = 2
+        while i < len(lines) and lines[i].strip():
+            group['slaves'].append((lines[i].strip(), lines[i+1].strip()))
+            i += 2
+        i += 1
+        while i < len(lines) and lines[i].strip():
+            path = lines[i].strip()
+            priority = int(lines[i+1].split()[0])
+            slaves = {}
+            for j, (name, link) in enumerate(group['slaves']):
+                slave = lines[i+2+j].strip()
+                if slave:
+                    slaves[name] = slave
+            group['alternatives'][path] = {'priority': priority, 'slaves': slaves}
+            i += 2 + len(group['slaves'])
+        return group
+    
+    def __init__(self, module, cmd, admindir, linkdir):
+        self.module = module
+        self.cmd = cmd
+        self.admindir = admindir
+        self.linkdir = linkdir
+        self._groups = None
+    
+    def groups(self):
+        if self._groups is None:
+            self._groups = {}
+            if os.path.isdir(self.admindir):
+                for name in os.listdir(self.admindir):
+                    path = os.path.join(self.admindir, name)
+                    if not os.path.isfile(path):
+                        continue
+                    with open(path, 'r') as f:
+                        try:
+                            self._groups[name] = self.parse(f.read())
+                        except (IndexError, ValueError):
+                            continue
+        return self._groups
+    
+    def owner(self, name):
+        # the group that has name as its master or as a slave
+        groups = self.groups()
+        if name in groups:
+            return name
+        for group, state in groups.items():
+            if name in [n for n, l in state['slaves']]:
+                return group
+        return None
+    
+    def current(self, name):
+        path = os.path.join(self.linkdir, name)
+        if not os.path.islink(path):
+            return None
+        return os.readlink(path)
+    
+    def run(self, argv):
+        self.module.run_command([self.cmd] + argv, True)
+        self._groups = None
+    
+    def install(self, name, link, path, priority, slaves=None):
+        # slaves maps names to (link, path)
+        slaves = slaves or {}
+        changed = False
+        state = self.groups().get(name)
+        registered = state is not None \
+            and state['link'] == link \
+            and path in state['alternatives'] \
+            and state['alternatives'][path]['priority'] == priority \
+            and state['alternatives'][path]['slaves'] == dict([(n, p) for n, (l, p) in slaves.items()]) \
+            and set([(n, l) for n, (l, p) in slaves.items()]) <= set(state['slaves'])
+        if not registered:
+            argv = ['--install', link, name, path, str(priority)]
+            for slave in sorted(slaves):
+                argv.extend(['--slave', slaves[slave][0], slave, slaves[slave][1]])
+            self.run(argv)
+            changed = True
+        if self.current(name) != path:
+            self.run(['--set', name, path])
+            changed = True
+        return changed
+    
+    @staticmethod
+    def under(path, home):
+        return path.startswith(home.rstrip('/') + '/')
+    
+    def remove(self, name, homes=(), keep=None, paths=()):
+        # only alternatives under homes, or among paths, are removed
+        changed = False
+        state = self.groups().get(name)
+        if state is None:
+            return changed
+        for path in sorted(state['alternatives']):
+            if keep is not None and self.under(path, keep):
+                continue
+            if path in paths or [h for h in homes if self.under(path, h)]:
+                self.run(['--remove', name, path])
+                changed = True
+        return changed
+
+#############################################################################
+#############################################################################
+
+class EnvFile(object):
+    """In-memory model of a file of NAME=value lines, such as /etc/environment.
+    
+    Lines that are not assignments are kept verbatim. The file is only
+    rewritten if its contents changed, through a temporary file that is
+    synced and renamed over the original.
+    """
+    
+    LINE_PATTERN = r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*?)\s*$'
+    # pam_env reads quoted values literally, and shells expand these
+    UNSAFE_CHARS = '"\\$`\n'
+    
+    @staticmethod
+    def unquote(value):
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+            return value[1:-1]
+        return value
+    
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.lines = f.readlines()
+        self.original = list(self.lines)
+    
+    def assignments(self, name):
+        for i, line in enumerate(self.lines):
+            m = re.match(self.LINE_PATTERN, line)
+            if m is not None and m.group(1) == name:
+                yield i, self.unquote(m.group(2))
+    
+    def get(self, name):
+        # the latest value wins
+        value = None
+        for i, v in self.assignments(name):
+            value = v
+        return value
+    
+    def set(self, name, value):
+        if any(c in value for c in self.UNSAFE_CHARS):
+            raise ValueError('%s cannot hold quotes, backslashes, $, backticks or newlines: %r'
+                             % (name, value))
+        if self.get(name) == value:
+            return
+        line = '%s="%s"\n' % (name, value)
+        indices = [i for i, v in self.assignments(name)]
+        if indices:
+            # replace the winning assignment in place
+            self.lines[indices[-1]] = line
+            self.lines = [l for i, l in enumerate(self.lines) if i not in indices[:-1]]
+        else:
+            if self.lines and not self.lines[-1].endswith('\n'):
+                self.lines[-1] += '\n'
+            self.lines.append(line)
+    
+    def unset(self, name, value=None):
+        indices = set([i for i, v in self.assignments(name)
+                       if value is None or v == value])
+        self.lines = [l for i, l in enumerate(self.lines) if i not in indices]
+    
+    @property
+    def changed(self):
+        return self.lines != self.original
+    
+    def write(self):
+        if not self.changed:
+            return False
+        AtomicFile.write(self.path, ''.join(self.lines))
+        self.original = list(self.lines)
+        return True
+
+#############################################################################
+#############################################################################
+
+class Ergonomics(object):
+    """JVM options sized to the resources the host grants.
+    
+    Cores and memory are read from /proc and capped by the limits of the
+    cgroup this runs in, which older JVMs do not see. The options apply
+    to every JVM on the host, so a heap limit is only set for an explicit
+    share of memory. Overrides replace the computed option of the same
+    flag, or any computed collector.
+    """
+    
+    CGROUP_DIR = '/sys/fs/cgroup'
+    MEMINFO_FILE = '/proc/meminfo'
+    NODE_DIR = '/sys/devices/system/node'
+    # what HotSpot takes for a server class machine
+    SERVER_CPUS = 2
+    SERVER_MEMORY = 1792 << 20
+    
+    @staticmethod
+    def read(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+    
+    @classmethod
+    def cpus(cls):
+        cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+        # cgroup v2, then v1
+        quota = cls.read(os.path.join(cls.CGROUP_DIR, 'cpu.max'))
+        if quota is not None:
+            quota, period = (quota.split() + [None])[:2]
+        else:
+            quota = cls.read(os.path.join(cls.CGROUP_DIR, 'cpu', 'cpu.cfs_quota_us'))
+            period = cls.read(os.path.join(cls.CGROUP_DIR, 'cpu', 'cpu.cfs_period_us'))
+        try:
+            quota, period = int(quota), int(period)
+        except (TypeError, ValueError):
+            # no quota
+            return cpus
+        if quota > 0 and period > 0:
+            cpus = min(cpus, max(1, -(-quota // period)))
+        return cpus
+    
+    @classmethod
+    def memory(cls):
+        memory = None
+        m = re.search(r'^MemTotal:\s+(\d+) kB', cls.read(cls.MEMINFO_FILE) or '', re.M)
+        if m is not None:
+            memory = int(m.group(1)) << 10
+        # v1 reports no limit as a huge number, v2 as 'max'
+        for path in (('memory.max',), ('memory', 'memory.limit_in_bytes',),):
+            limit = cls.read(os.path.join(cls.CGROUP_DIR, *path))
+            if limit and limit.isdigit():
+                memory = min(memory, int(limit)) if memory else int(limit)
+        return memory
+    
+    @classmethod
+    def nodes(cls):
+        if not os.path.isdir(cls.NODE_DIR):
+            return 1
+        return max(1, len([d for d in os.listdir(cls.NODE_DIR) if re.match(r'^node\d+$', d)]))
+    
+    @staticmethod
+    def key(option):
+        m = re.match(r'^-XX:[+-]?(\w+)', option)
+        if m is not None:
+            name = m.group(1)
+            return 'GC' if re.match(r'^Use\w+GC$', name) else name
+        m = re.match(r'^(-X(?:mx|ms|mn|ss))', option)
+        return m.group(1) if m is not None else option
+    
+    @classmethod
+    def merge(cls, options, overrides):
+        keys = set([cls.key(o) for o in overrides])
+        return [o for o in options if cls.key(o) not in keys] + list(overrides)
+    
+    @classmethod
+    def profile(cls, module):
+        cpus, memory, nodes = cls.cpus(), cls.memory(), cls.nodes()
+        options = []
+        percent = int(module.params.get('ergonomics_heap_percent') or 0)
+        if memory and percent > 0:
+            options.append('-Xmx%dm' % ((memory * min(percent, 100) // 100) >> 20))
+        if cpus < cls.SERVER_CPUS or (memory and memory < cls.SERVER_MEMORY):
+            options.append('-XX:+UseSerialGC')
+        else:
+            # as HotSpot sizes them from the cores it sees
+            threads = cpus if cpus <= 8 else 8 + (cpus - 8) * 5 // 8
+            options.extend(['-XX:+UseParallelGC',
+                            '-XX:ParallelGCThreads=%d' % threads])
+            if nodes > 1:
+                options.append('-XX:+UseNUMA')
+        return cls.merge(options, module.params.get('ergonomics_options') or [])
+
+#############################################################################
+#############################################################################
+
 class JavaEnv(object):
 
     ENV_VAR = 'JAVA_HOME'
-    ENV_PATTERN = r"^[:space]*JAVA_HOME[:space]*="
+    PATH_VAR = 'PATH'
+    OPTIONS_VAR = 'JAVA_TOOL_OPTIONS'
+    ALTERNATIVES_GROUPS = ('java', 'javac',)
+    ALTERNATIVES_PRIORITY = 1
+    
+    @staticmethod
+    def strip_path(path, home):
+        # drop the bin directories of any Java next to home
+        root = os.path.join(os.path.dirname(home), '')
+        return [e for e in path.split(':')
+                if not (e.startswith(root) and os.path.basename(e.rstrip('/')) == 'bin')]
+    
+    @staticmethod
+    def alternatives(module, distro):
+        return Alternatives(module, distro.ALTERNATIVES_CMD, distro.ALTERNATIVES_DIR,
+                            distro.ALTERNATIVES_LINK_DIR)
+    
+    @classmethod
+    def env_file(cls, module, distro, home, owned=False):
+        # the env file as it is to be with home installed, before it is
+        # written; owned is whether an earlier run set JAVA_TOOL_OPTIONS
+        env = EnvFile(distro.ENV_FILE)
+        env.set(cls.ENV_VAR, home)
+        # a PATH is only edited, never introduced, since it replaces the default
+        path = env.get(cls.PATH_VAR)
+        if module.params.get('update_path') and path is not None:
+            entries = [os.path.join(home, 'bin')] + cls.strip_path(path, home)
+            env.set(cls.PATH_VAR, ':'.join(entries))
+        options = module.params.get('java_tool_options')
+        if module.params.get('ergonomics') == 'env':
+            # explicit options override the profile flag by flag, and are
+            # kept as written, quoting and all
+            profile = Ergonomics.profile(module)
+            explicit = set([Ergonomics.key(o) for o in shlex.split(options or '')])
+            kept = [pipes.quote(o) for o in profile if Ergonomics.key(o) not in explicit]
+            options = ' '.join(kept + ([options.strip()] if explicit else []))
+        if options:
+            env.set(cls.OPTIONS_VAR, options)
+        elif options is not None or owned:
+            env.unset(cls.OPTIONS_VAR)
+        return env
+    
+    @classmethod
+    def update_env(cls, module, distro, home, owned=False):
+        return cls.env_file(module, distro, home, owned).write()
+    
+    @classmethod
+    def pending(cls, module, distro, home, owned=False):
+        # whether installing home would change anything
+        if cls.env_file(module, distro, home, owned).changed:
+            return True
+        master = cls.ALTERNATIVES_GROUPS[0]
+        source = os.path.join(home, 'bin', master)
+        alternatives = cls.alternatives(module, distro)
+        return not os.path.exists(source) or alternatives.current(master) != source
+    
+    @classmethod
+    def clear_env(cls, module, distro, home='', owned=False):
+        env = EnvFile(distro.ENV_FILE)
+        path = env.get(cls.PATH_VAR)
+        if module.params.get('update_path') and path is not None:
+            root = home or env.get(cls.ENV_VAR)
+            if root:
+                env.set(cls.PATH_VAR, ':'.join(cls.strip_path(path, root)))
+        env.unset(cls.ENV_VAR, home or None)
+        if owned or module.params.get('java_tool_options') is not None \
+                or module.params.get('ergonomics') == 'env':
+            env.unset(cls.OPTIONS_VAR)
+        return env.write()
+    
+    @classmethod
+    def update_alternatives(cls, module, distro, home, managed=()):
+        alternatives = cls.alternatives(module, distro)
+        bindir = os.path.join(home, 'bin')
+        master = cls.ALTERNATIVES_GROUPS[0]
+        source = os.path.join(bindir, master)
+        if not os.path.exists(source):
+            return False
+        changed = False
+        
+        # every other tool in home is a slave of the java group
+        slaves = {}
+        for prog in sorted(os.listdir(bindir)):
+            path = os.path.join(bindir, prog)
+            link = os.path.join(distro.BIN_DIR, prog)
+            if prog == master or not os.access(path, os.X_OK) or os.path.isdir(path):
+                continue
+            if os.path.exists(link) and not os.path.islink(link):
+                continue
+            owner = alternatives.owner(prog)
+            if owner == prog:
+                # a group of its own, as registered by an older version of this
+                # module, but system packages register their tools the same way
+                ours = [os.path.join(h, 'bin', prog) for h in [home] + list(managed)]
+                changed = alternatives.remove(prog, paths=ours) or changed
+                owner = alternatives.owner(prog)
+            if owner not in (None, master):
+                continue
+            slaves[prog] = (link, path)
+        
+        link = os.path.join(distro.BIN_DIR, master)
+        changed = alternatives.install(master, link, source, cls.ALTERNATIVES_PRIORITY, slaves) or changed
+        return changed
+    
+    @classmethod
+    def remove_alternatives(cls, module, distro, homes, keep=None):
+        # the alternatives of other Javas, e.g. a system OpenJDK, are kept
+        alternatives = cls.alternatives(module, distro)
+        changed = False
+        for prog in cls.ALTERNATIVES_GROUPS:
+            changed = alternatives.remove(prog, homes, keep) or changed
+        return changed
     
     @classmethod    
-    def install(cls, module, distro, home):
+    def install(cls, module, distro, home, replace=False, managed=(), owned=False):
         changed = False
         
-        # add home to system env file
-        do_append = True
-        pattern = cls.ENV_PATTERN
-        argv = ['grep', '-E', "%s" % pattern, distro.ENV_FILE]
-        result = module.run_command(argv)
-        if result[0] == 0:
-            output = [l for l in result[1].splitlines(True) if '=' in l]
-            assert len(output), output
-            # assume that the latest value wins
-            kv = [w.strip() for w in output[-1].strip().split('=')]
-            assert kv[0] == cls.ENV_VAR, kv
-            if kv[1].strip('"') == home:
-                # home already set to requested value
-                do_append = False
-            else:
-                # delete existing JAVA_HOME
-                # it would be better to comment out, but unsure of file format
-                lines = []
-                with open(distro.ENV_FILE, 'r') as f:
-                    for line in f:
-                        if line not in output:
-                            lines.append(line)
-                with open(distro.ENV_FILE, 'w') as f:
-                    f.writelines(lines)
-                changed = True
-        # append new value
-        if do_append:
-            with open(distro.ENV_FILE, 'a') as f:
-                f.write('%s="%s"\n' % (cls.ENV_VAR, home))
-            changed = True
-        
-        # update system alternatives
-        cmd = distro.ALTERNATIVES_CMD
-        for prog in ('java', 'javac',):
-            source = os.path.join(home, 'bin', prog)
-            if not os.path.exists(source):
-                continue
-            dest = os.path.join('/usr/bin', prog)
-            argv = [cmd, '--install', dest, prog, source, '1',]
-            module.run_command(argv, True)
-            argv = [cmd, '--set', prog, source,]
-            module.run_command(argv, True)
-            changed = True
+        with Metrics.timer(module, 'env'):
+            # drop the alternatives of any other home first
+            if replace:
+                changed = cls.remove_alternatives(module, distro, managed, home) or changed
+            
+            # set home in system env file
+            changed = cls.update_env(module, distro, home, owned) or changed
+            
+            # update system alternatives
+            changed = cls.update_alternatives(module, distro, home, managed) or changed
         
         return changed
     
     @classmethod 
-    def uninstall(cls, module, distro, home=''):
+    def uninstall(cls, module, distro, home='', managed=(), owned=False):
         changed = False
         
-        # remove home from system env file
-        pattern = cls.ENV_PATTERN
-        if home:
-            pattern += r'[:space]*"?' + home + r'"?[:space]*$'
-        argv = ['grep', '-E', "%s" % pattern, distro.ENV_FILE]
-        result = module.run_command(argv)
-        if result[0] == 0:
-            output = [l for l in result[1].splitlines(True) if '=' in l]
-            assert len(output), output
-            lines = []
-            with open(distro.ENV_FILE, 'r') as f:
-                for line in f:
-                    if line not in output:
-                        lines.append(line)
-            with open(distro.ENV_FILE, 'w') as f:
-                f.writelines(lines)
-            changed = True
-        
-        # update system alternatives
-        cmd = distro.ALTERNATIVES_CMD
-        # alternatives doesn't have --list
-        for prog in ('java', 'javac',):
-            args = ' '.join([cmd, '--display', prog,]) + " | grep -E '^/'"
-            result = module.run_command(args)
-            if result[0] == 0:
-                for line in result[1].splitlines():
-                    path = line.split()[0]
-                    if path.startswith(home):
-                        argv = [cmd, '--remove', prog, path,]
-                        module.run_command(argv, True)
-                        changed = True
+        with Metrics.timer(module, 'env'):
+            # remove home from system env file
+            changed = cls.clear_env(module, distro, home, owned) or changed
+            
+            # update system alternatives
+            changed = cls.remove_alternatives(module, distro, [home] if home else managed) or changed
         
         return changed
         
 #############################################################################
 #############################################################################
 
+class JavaCds(object):
+    """Class data sharing archives of a Java home.
+    
+    The default archive is dumped next to the JVM library, and one
+    archive per application class list beside it. Each archive has a
+    stamp of the mtime and size of the library it was dumped by, and is
+    dumped again when the library no longer matches its stamp, or when
+    its class list is newer than it.
+    """
+    
+    ARCHIVE_FILE = 'classes.jsa'
+    LIBRARY_FILE = 'libjvm.so'
+    STAMP_SUFFIX = '.stamp'
+    VMS = ('server', 'client',)
+    RUNS = 3
+    
+    @classmethod
+    def jvm_dir(cls, home):
+        # e.g. jre/lib/amd64/server, or lib/server from Java 9
+        for lib in (os.path.join(home, 'jre', 'lib'), os.path.join(home, 'lib')):
+            if not os.path.isdir(lib):
+                continue
+            for vm in cls.VMS:
+                dirnames = [os.path.join(lib, vm)]
+                dirnames.extend([os.path.join(lib, arch, vm) for arch in sorted(os.listdir(lib))])
+                for dirname in dirnames:
+                    if os.path.isfile(os.path.join(dirname, cls.LIBRARY_FILE)):
+                        return dirname
+        return None
+    
+    @classmethod
+    def archives(cls, home, lists=()):
+        # (archive, class list) pairs, the default archive first
+        jvmdir = cls.jvm_dir(home)
+        if jvmdir is None:
+            return []
+        archives = [(os.path.join(jvmdir, cls.ARCHIVE_FILE), None)]
+        for classlist in lists:
+            name = os.path.splitext(os.path.basename(classlist))[0]
+            archives.append((os.path.join(jvmdir, name + '.jsa'), classlist))
+        return archives
+    
+    @classmethod
+    def installed(cls, archives):
+        # not the ctime, which every hard link made by dedup changes
+        st = os.stat(os.path.join(os.path.dirname(archives[0][0]), cls.LIBRARY_FILE))
+        return [int(st.st_mtime), st.st_size]
+    
+    @classmethod
+    def outdated(cls, archive, classlist, installed):
+        if not os.path.isfile(archive):
+            return True
+        try:
+            with open(archive + cls.STAMP_SUFFIX, 'r') as f:
+                if json.load(f) != installed:
+                    return True
+        except (IOError, ValueError):
+            return True
+        return bool(classlist and os.stat(archive).st_mtime < os.stat(classlist).st_mtime)
+    
+    @classmethod
+    def stale(cls, home, lists=()):
+        if not os.path.exists(home):
+            return True
+        archives = cls.archives(home, lists)
+        if not archives:
+            # not a JVM this can dump
+            return False
+        installed = cls.installed(archives)
+        return any(cls.outdated(archive, classlist, installed) for archive, classlist in archives)
+    
+    @classmethod
+    def dump(cls, module, home, archive, classlist, installed):
+        # the old archive may be linked with another home's
+        for path in (archive, archive + cls.STAMP_SUFFIX):
+            if os.path.lexists(path):
+                os.remove(path)
+        argv = [os.path.join(home, 'bin', 'java'), '-Xshare:dump']
+        if classlist:
+            argv.extend(['-XX:+UnlockDiagnosticVMOptions',
+                         '-XX:SharedClassListFile=%s' % classlist,
+                         '-XX:SharedArchiveFile=%s' % archive])
+        module.run_command(argv, True)
+        AtomicFile.write(archive + cls.STAMP_SUFFIX, json.dumps(installed))
+    
+    @classmethod
+    def startup(cls, module, home):
+        # the best of a few launches with sharing off and as the JVM
+        # defaults to, which is what applications get; -Xshare:on would
+        # also force e.g. the serial collector on some 64-bit VMs
+        java = os.path.join(home, 'bin', 'java')
+        times = {}
+        mapped = False
+        for share in ('-Xshare:off', None,):
+            best = None
+            for i in range(cls.RUNS):
+                # each launch is timed, not answered from memory
+                invalidate = getattr(module, 'invalidate', None)
+                if invalidate is not None:
+                    invalidate()
+                start = time.time()
+                rc, out, err = module.run_command([java] + ([share] if share else []) + ['-version'])
+                elapsed = time.time() - start
+                if rc != 0:
+                    return None
+                if share is None:
+                    # e.g. "(build 24.76-b04, mixed mode, sharing)"
+                    mapped = 'sharing' in err + out
+                best = elapsed if best is None else min(best, elapsed)
+            times[share] = int(best * 1000)
+        return {
+            'off_ms': times['-Xshare:off'],
+            'default_ms': times[None],
+            'delta_ms': times['-Xshare:off'] - times[None],
+            'mapped': mapped,
+        }
+    
+    @classmethod
+    def install(cls, module, home, lists=()):
+        result = {'java_home': home, 'archives': [], 'changed': False}
+        with Metrics.timer(module, 'cds'):
+            archives = cls.archives(home, lists)
+            installed = cls.installed(archives) if archives else None
+            for archive, classlist in archives:
+                if cls.outdated(archive, classlist, installed):
+                    cls.dump(module, home, archive, classlist, installed)
+                    result['changed'] = True
+                result['archives'].append(archive)
+            if result['changed']:
+                result['startup'] = cls.startup(module, home)
+        return result
+
+#############################################################################
+#############################################################################
+
 class Java(object):
 
     # see http://stackoverflow.com/questions/10268583/how-to-automate-download-and-installation-of-java-jdk-on-linux
-    ORACLE_COOKIE = 'Cookie: oraclelicense=accept-securebackup-cookie'
+    ORACLE_COOKIE = 'oraclelicense=accept-securebackup-cookie'
     ORACLE_DOWNLOAD_URL = 'http://download.oracle.com/otn-pub/java/jdk/'
     ORACLE_FILE_PATTERN = r'^(\w+)-(\w+)-linux-(\w+)((?:\.|-).+)$'
     ORACLE_FILE_TEMPLATE = '%s-%s-linux-%s%s'
     
-    # TODO: get latest versions dynamically
-    LATEST_VERSION = { 
-#        7: JavaVersion(7, 0, 72, 14),
-        7: JavaVersion(7, 0, 76, 13),
-    }
+    # builds in the bundled catalog
+    RELEASES = (
+#        JavaVersion(7, 0, 72, 14),
+        JavaVersion(7, 0, 76, 13),
+    )
+    ARCHES = ('x64', 'i586',)
+    FORMAT = 'tar.gz'
     
     JAVA_HOME = '/usr/lib/jvm'
+    MANIFEST_FILE = '/var/lib/ansible-java/manifest.json'
+    DEDUP_FILE = '/var/lib/ansible-java/dedup.json'
+    RELEASE_FILE = 'release'
+    RELEASE_PATTERN = r'^JAVA_VERSION="([^"]+)"'
+    HOME_PATTERN = r'^(jdk|jre)-?(.+)$'
+    LAUNCHER_PATTERN = br'\b(1\.[0-9]\.\d+_\d+)'
+    LAUNCHER_SIZE = 1 << 20
+    
+    catalogs = {}
     
     arguments = {
         'state': {'default': 'jre', 'choices': ['none', 'jre', 'jdk',],},
-        'package_location': {'default': None,}
+        'package_location': {'default': None,},
+        'cache_valid_time': {'default': 0, 'type': 'int',},
+        'cache_dir': {'default': '/var/cache/ansible-java',},
+        'cache_max_size': {'default': 1024, 'type': 'int',},
+        'download_connections': {'default': 4, 'type': 'int',},
+        'download_retries': {'default': 5, 'type': 'int',},
+        'download_timeout': {'default': 60, 'type': 'int',},
+        'extract_workers': {'default': 4, 'type': 'int',},
+        'stream': {'default': False, 'type': 'bool',},
+        'verify_version': {'default': False, 'type': 'bool',},
+        'update_path': {'default': False, 'type': 'bool',},
+        'java_tool_options': {'default': None,},
+        'write_sources': {'default': True, 'type': 'bool',},
+        'apt_key_file': {'default': None,},
+        'versions': {'default': None, 'type': 'list',},
+        'default': {'default': None,},
+        'workers': {'default': 2, 'type': 'int',},
+        'catalog': {'default': None,},
+        'max_commands': {'default': 0, 'type': 'int',},
+        'metrics_file': {'default': None,},
+        'dedup': {'default': 'none', 'choices': ['none', 'hardlink', 'reflink'],},
+        'image_cache': {'default': False, 'type': 'bool',},
+        'delete_in_background': {'default': True, 'type': 'bool',},
+        'cds': {'default': False, 'type': 'bool',},
+        'cds_class_lists': {'default': None, 'type': 'list',},
+        'ergonomics': {'default': 'none', 'choices': ['none', 'env'],},
+        'ergonomics_heap_percent': {'default': 0, 'type': 'int',},
+        'ergonomics_options': {'default': None, 'type': 'list',},
     }
 
     @classmethod
-    def discover_version(cls, module, jdk=False):
+    def discover_home(cls, module, jdk=False):
+        # follows the java (or javac) on the path through any alternatives
+        path = module.get_bin_path('javac' if jdk else 'java')
+        if not path:
+            return None
+        bindir = os.path.dirname(os.path.realpath(path))
+        if os.path.basename(bindir) != 'bin':
+            return None
+        return os.path.dirname(bindir)
+    
+    @classmethod
+    def read_version(cls, home):
+        # the JRE of a JDK lives in jdk/jre
+        dirnames = (home, os.path.dirname(home))
+        release = None
+        for path in dirnames:
+            path = os.path.join(path, cls.RELEASE_FILE)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r') as f:
+                text = [m.group(1) for m in [re.match(cls.RELEASE_PATTERN, l) for l in f] if m is not None]
+            if text:
+                release = JavaVersion.from_string(text[0])
+                # Oracle 7 releases leave out the update, e.g. 1.7.0
+                if release is not None and re.search(r'_\d+', text[0]):
+                    return release
+            break
+        # the launcher and the name of the home do not
+        for path in dirnames:
+            version = cls.launcher_version(path)
+            if version is not None:
+                return version
+        for path in dirnames:
+            m = re.match(cls.HOME_PATTERN, os.path.basename(path))
+            if m is not None and JavaVersion.from_string(m.group(2)) is not None:
+                return JavaVersion.from_string(m.group(2))
+        # e.g. java-7-oracle, which is still better than forking the JVM
+        return release
+    
+    @classmethod
+    def launcher_version(cls, home):
+        # the launcher is built with the full version in it, e.g. 1.7.0_76-b13
+        try:
+            with open(os.path.join(home, 'bin', 'java'), 'rb') as f:
+                data = f.read(cls.LAUNCHER_SIZE)
+        except IOError:
+            return None
+        m = re.search(cls.LAUNCHER_PATTERN, data)
+        return JavaVersion.from_string(m.group(1).decode('ascii')) if m is not None else None
+    
+    @classmethod
+    def probe_version(cls, module, jdk=False):
         version = None
         if jdk:
             args = ' | '.join(("javac 2>&1 -version",
@@ -460,6 +2899,17 @@ class Java(object):
                 raise RuntimeError("'Unable to parse Java version '%s'" % text)
         return version
     
+    @classmethod
+    def discover_version(cls, module, jdk=False):
+        home = cls.discover_home(module, jdk)
+        if home is None:
+            return None
+        version = cls.read_version(home)
+        if version is None or module.params.get('verify_version'):
+            # fall back to asking the JVM
+            version = cls.probe_version(module, jdk)
+        return version
+    
     @classmethod
     def discover_arch(cls):
         return 'x64' if platform.machine() == 'x86_64' else 'i586'
@@ -481,48 +2931,296 @@ class Java(object):
         return url
     
     @classmethod
-    def url(cls, version, jdk, rpm):
+    def default_catalog(cls):
+        entries = []
+        for version in cls.RELEASES:
+            for arch in cls.ARCHES:
+                for kind in ('jre', 'jdk',):
+                    for rpm in (False, True):
+                        url = cls.ORACLE_DOWNLOAD_URL + version.build_string() + '/' \
+                            + cls.ORACLE_FILE_TEMPLATE % (kind, version.update_string(), arch,
+                                                          '.rpm' if rpm else '.tar.gz')
+                        entries.append({
+                            'version': version.update_string(),
+                            'build': version.build,
+                            'arch': arch,
+                            'kind': kind,
+                            'format': 'rpm' if rpm else 'tar.gz',
+                            'url': url,
+                        })
+        return ReleaseCatalog(entries)
+    
+    @classmethod
+    def catalog(cls, module):
+        # loaded once per source
+        source = module.params.get('catalog')
+        if source not in cls.catalogs:
+            if source:
+                cls.catalogs[source] = ReleaseCatalog.load(source)
+            else:
+                cls.catalogs[source] = cls.default_catalog()
+        return cls.catalogs[source]
+    
+    @classmethod
+    def release(cls, module, version, jdk=False, rpm=False):
+        return cls.catalog(module).find(version, 'jdk' if jdk else 'jre',
+                                        cls.discover_arch(), 'rpm' if rpm else 'tar.gz')
+    
+    @classmethod
+    def url(cls, module, version, jdk, rpm):
+        entry = cls.release(module, version, jdk, rpm)
+        if entry is not None and entry['url']:
+            return entry['url']
         return cls.oracle_url(version, jdk, rpm)
     
     @classmethod
     def java_home(cls, version, jdk=False):
-        latest = cls.LATEST_VERSION[version.major]
-        return os.path.join(cls.JAVA_HOME, 
-                            ('jdk' if jdk else 'jre') + latest.version_string())
+        return cls.tarball_home(version, jdk)
             
     @classmethod
-    def fetch_package(cls, module, distro, version, jdk=False, rpm=False, destdir=None):
+    def tarball_home(cls, version, jdk=False):
+        return os.path.join(cls.JAVA_HOME,
+                            ('jdk' if jdk else 'jre') + version.version_string())
+    
+    @classmethod
+    def tarball_homes(cls):
+        if not os.path.isdir(cls.JAVA_HOME):
+            return []
+        return [os.path.join(cls.JAVA_HOME, f) for f in sorted(os.listdir(cls.JAVA_HOME))
+                if re.match(cls.HOME_PATTERN, f) and not os.path.islink(os.path.join(cls.JAVA_HOME, f))
+                and os.path.isdir(os.path.join(cls.JAVA_HOME, f))]
+    
+    def dedup_homes(self):
+        # images hold a link to every file of their homes, so theirs are
+        # linked too, or nothing would be freed
+        images = self.image_cache(self.module)
+        return self.tarball_homes() + (images.homes() if images is not None else [])
+    
+    @classmethod
+    def mirror(cls, module):
+        # a local package_location that is not itself a package is a mirror
+        source = module.params.get('package_location')
+        if not source or not source.startswith('/'):
+            return None
+        if not os.path.exists(source):
+            raise ValueError("Non-existent path: %s" % source)
+        if os.path.isfile(source) and MirrorCatalog.parse(source) is not None:
+            return None
+        return MirrorCatalog.scan(source)
+    
+    @classmethod
+    def resolve_version(cls, module, version, jdk=False, rpm=False):
+        # the build to install for a requested version
+        mirror = cls.mirror(module)
+        if mirror is not None:
+            # the newest release the mirror holds
+            entry = mirror.find(version, 'jdk' if jdk else 'jre', cls.discover_arch(), 'rpm' if rpm else 'tar.gz')
+            if entry is None:
+                raise NotImplementedError('No build of Java %s in %s' \
+                                          % (version.update_string(), module.params['package_location']))
+            version = entry['version']
+        entry = cls.release(module, version, jdk, rpm)
+        if entry is not None:
+            return entry['version']
+        if version.release and (version.build or mirror is not None):
+            # not in the catalog, but fully specified
+            return version
+        raise NotImplementedError('No known build of Java %s' % version.update_string())
+    
+    @classmethod
+    def parse_target(cls, module, target):
+        kind, sep, text = target.partition(':')
+        if kind not in ('jre', 'jdk',):
+            raise ValueError('Invalid Java target: %s' % target)
+        version = JavaVersion.from_string(text or str(max(cls.catalog(module).majors())))
+        if version is None:
+            raise ValueError('Invalid Java version: %s' % target)
+        return kind, cls.resolve_version(module, version, kind == 'jdk')
+    
+    @classmethod
+    def artifact_cache(cls, module):
+        root = module.params.get('cache_dir')
+        if not root:
+            return None
+        max_size = int(module.params.get('cache_max_size') or 0) * (1 << 20)
+        return ArtifactCache(root, max_size)
+    
+    @classmethod
+    def image_cache(cls, module):
+        root = module.params.get('cache_dir')
+        if not root or not module.params.get('image_cache'):
+            return None
+        return ImageCache(root)
+    
+    @classmethod
+    def known_digest(cls, module, version, jdk=False, rpm=False):
+        # the digest of a package, if it was fetched before or is in the catalog
+        cache = cls.artifact_cache(module)
+        digest = None
+        if cache is not None:
+            digest = cache.known_digest(cls.package_key(cache, version, jdk, rpm))
+        return digest or (cls.release(module, version, jdk, rpm) or {}).get('sha256')
+    
+    @classmethod
+    def package_source(cls, module, version, jdk=False, rpm=False):
         filename = cls.oracle_file(version, jdk, rpm)
         
         # use custom location if specified
         source = module.params['package_location']
         if source:
-            if source.startswith('/'):
-                if not os.path.exists(source):
-                    raise ValueError("Non-existent path: %s" % source)
-                if os.path.isdir(source) and not source.endswith('/'):
-                    source += '/'
-            if source.endswith('/'):
+            mirror = cls.mirror(module)
+            if mirror is not None:
+                entry = mirror.find(version, 'jdk' if jdk else 'jre', cls.discover_arch(), 'rpm' if rpm else 'tar.gz')
+                if entry is None:
+                    raise ValueError("Non-existent package: %s in %s" % (filename, source))
+                source = entry['url']
+            elif source.endswith('/'):
                 source += filename
-                if not os.path.exists(source):
-                    raise ValueError("Non-existent package: %s" % source)
         else:
-            source = cls.url(version, jdk, rpm)
+            source = cls.url(module, version, jdk, rpm)
+        return source
+    
+    @classmethod
+    def package_headers(cls, source):
+        if source.startswith(cls.ORACLE_DOWNLOAD_URL):
+            return {'Cookie': cls.ORACLE_COOKIE}
+        return None
+    
+    @classmethod
+    def package_key(cls, cache, version, jdk=False, rpm=False):
+        return cache.key(version, 'jdk' if jdk else 'jre',
+                         cls.discover_arch(), 'rpm' if rpm else 'tar.gz')
+    
+    @classmethod
+    def fetch_package(cls, module, distro, version, jdk=False, rpm=False, destdir=None, stats=None):
+        filename = cls.oracle_file(version, jdk, rpm)
+        source = cls.package_source(module, version, jdk, rpm)
+        
+        entry = cls.release(module, version, jdk, rpm) or {}
+        expected = entry.get('sha256')
         
         dest = None
         if source.startswith('/'): # assume local file
             dest = source
+            # checked like a download, but never removed
+            if expected is not None and os.path.isfile(dest):
+                with Metrics.timer(module, 'verify'):
+                    digest = ArtifactCache.digest(dest)
+                if digest != expected:
+                    raise RuntimeError('Checksum mismatch for %s: expected %s, got %s' \
+                                       % (source, expected, digest))
         else: # assume url
-            if source.startswith(cls.ORACLE_DOWNLOAD_URL):
-                opts = ('-c', '--no-cookies', '--header', cls.ORACLE_COOKIE,)
-            else:
-                opts = None
-            dest = distro.download(module, source, opts=opts, destfile=filename, destdir=destdir)
+            cache = cls.artifact_cache(module)
+            if cache is not None:
+                key = cls.package_key(cache, version, jdk, rpm)
+                dest = cache.lookup(key)
+                if dest is not None:
+                    if expected is None or cache.known_digest(key) == expected:
+                        return dest
+                    dest = None
+                destdir = cache.staging
+            headers = cls.package_headers(source)
+            with Metrics.timer(module, 'download'):
+                dest = distro.download(module, source, headers=headers, destfile=filename, destdir=destdir,
+                                       size=entry.get('size'), stats=stats)
+            if cache is not None:
+                dest = cache.add(key, dest)
+                digest = cache.known_digest(key)
+            elif expected is not None:
+                digest = ArtifactCache.digest(dest)
+            if expected is not None and digest != expected:
+                os.remove(dest)
+                raise RuntimeError('Checksum mismatch for %s: expected %s, got %s' \
+                                   % (source, expected, digest))
         assert os.path.exists(dest), dest
         return dest
     
     @classmethod
-    def extract_package(cls, module, distro, source, destdir=None):
+    def stream_package(cls, module, distro, version, jdk=False, destdir=None, downloads=None, extractions=None):
+        # returns None if the package is not fetched from a url
+        filename = cls.oracle_file(version, jdk)
+        source = cls.package_source(module, version, jdk)
+        if source.startswith('/'):
+            return None
+        expected = (cls.release(module, version, jdk) or {}).get('sha256')
+        cache = cls.artifact_cache(module)
+        if cache is not None:
+            key = cls.package_key(cache, version, jdk)
+            if cache.lookup(key) is not None:
+                return None
+            expected = expected or cache.known_digest(key)
+        if expected is None:
+            # an extracted tree cannot be checked after the fact, so a
+            # package with no known digest is fetched whole and staged
+            return None
+        
+        dest = os.path.join(destdir, ('jdk' if jdk else 'jre') + version.version_string())
+        if os.path.exists(dest):
+            return dest
+        downloader = distro.downloader(module, cls.package_headers(source))
+        extractor = TarExtractor()
+        
+        def stream():
+            start = time.time()
+            staging = tempfile.mkdtemp(prefix='.staging-', dir=destdir)
+            try:
+                response = downloader.open(source)
+                try:
+                    reader = HashingReader(response)
+                    manifest = {}
+                    try:
+                        extraction = extractor.extract(reader, staging, manifest=manifest)
+                    except (tarfile.TarError, zlib.error) as e:
+                        # most likely a truncated or corrupted transfer, so retried
+                        raise IOError('Corrupt archive %s: %s' % (source, e))
+                    reader.drain()
+                    length = response.info().getheader('Content-Length')
+                finally:
+                    response.close()
+                if length is not None and int(length) != reader.size:
+                    raise IOError('Short read: %d of %s bytes' % (reader.size, length))
+                digest = reader.hexdigest()
+                if digest != expected:
+                    raise IOError('Checksum mismatch for %s: expected %s, got %s' \
+                                  % (source, expected, digest))
+                try:
+                    extractor.validate(staging, manifest)
+                except RuntimeError as e:
+                    raise IOError(str(e))
+                os.rename(os.path.join(staging, os.path.basename(dest)), dest)
+                extraction['dest'] = destdir
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            elapsed = time.time() - start
+            download = {
+                'url': source,
+                'dest': dest,
+                'size': reader.size,
+                'bytes': reader.size,
+                'segments': 1,
+                'ranged': False,
+                'sha256': digest,
+                'seconds': round(elapsed, 3),
+                'bytes_per_second': int(reader.size / elapsed) if elapsed > 0 else 0,
+            }
+            return digest, download, extraction
+        
+        try:
+            # downloading and extracting overlap, so are timed as one
+            with Metrics.timer(module, 'stream'):
+                digest, download, extraction = downloader.retry(stream)
+        except (IOError, httplib.HTTPException) as e:
+            raise RuntimeError('Error: Download of %s failed: %s' % (source, e))
+        if cache is not None:
+            cache.record(key, digest, filename)
+        if downloads is not None:
+            downloads.append(download)
+        if extractions is not None:
+            extractions.append(extraction)
+        return dest
+    
+    @classmethod
+    def extract_package(cls, module, distro, source, destdir=None, stats=None):
         assert os.path.exists(source), source
         sourcedir, sourcefile = os.path.split(source)
         m = re.match(cls.ORACLE_FILE_PATTERN, sourcefile)
@@ -542,82 +3240,489 @@ class Java(object):
             raise RuntimeError(destdir)
         dest = os.path.join(destdir, destfile)
         if not os.path.exists(dest):
-            cwd = os.getcwd()
-            os.chdir(destdir)
-            if suffix.endswith('.bin'):
-                o755 = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
-                os.chmod(source, o755)
-                argv = [source]
-                module.run_command(argv, True)
-            elif suffix == '.tar.gz':
-                argv = ['tar', 'xzf', source]
-                module.run_command(argv, True)
-            else:
-                assert False, suffix
-            os.chdir(cwd)
+            # only a complete, validated tree is renamed into place
+            staging = tempfile.mkdtemp(prefix='.staging-', dir=destdir)
+            try:
+                if suffix.endswith('.bin'):
+                    o755 = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+                    os.chmod(source, o755)
+                    # run_command takes no cwd before Ansible 1.5
+                    cmd = 'cd %s && %s' % (pipes.quote(staging), pipes.quote(source))
+                    with Metrics.timer(module, 'extraction'):
+                        module.run_command(cmd, True)
+                elif suffix == '.tar.gz':
+                    extractor = TarExtractor()
+                    manifest = {}
+                    with Metrics.timer(module, 'extraction'):
+                        with open(source, 'rb') as f:
+                            result = extractor.extract(f, staging, manifest=manifest)
+                        extractor.validate(staging, manifest)
+                    result['dest'] = destdir
+                    if stats is not None:
+                        stats.append(result)
+                else:
+                    assert False, suffix
+                staged = os.path.join(staging, destfile)
+                if not os.path.isdir(staged):
+                    raise RuntimeError('%s did not extract to %s' % (source, destfile))
+                os.rename(staged, dest)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
         assert os.path.exists(dest), dest
         return dest
             
     @classmethod
-    def main(cls, module, *args, **kwargs):
-        distro = Distribution.discover(module)
+    def main(cls, module, distro=None, *args, **kwargs):
+        # every command goes through one runner, to be counted and capped
+        runner = CommandRunner(module, int(module.params.get('max_commands') or 0))
+        # a given distro, with its own paths, runs the module away from the host's
+        if distro is None:
+            distro = Distribution.discover(runner)
         subcls = distro.Java
-        self = subcls(module, distro, *args, **kwargs)
+        self = subcls(runner, distro, *args, **kwargs)
         return self.apply()
 
     def __init__(self, module, distro):
         self.module = module
         self.distro = distro
-        self.packages = distro.PackageManager(module)
+        self.packages = distro.PackageManager(module, distro)
+        self.downloads = []
+        self.extractions = []
+        self.dedups = []
+        self.images = []
+        self.cds = []
+        self.versions = {}
+        self.package = None
 
-    def install(self, state, version, rpm=False):
+    def plan(self, current_state, target_state, version=None):
+        # what takes the host from one state to the other, from cheap reads
+        plan = Plan()
+        if current_state != 'none':
+            self.plan_uninstall(plan)
+        if target_state != 'none':
+            self.plan_install(plan, target_state, version)
+            self.plan_home(plan, self.java_home(version, target_state == 'jdk'))
+        return plan
+    
+    def plan_home(self, plan, home):
+        # what a home needs beyond its package, installed or not
+        # homes installed from packages are left to the package manager
+        if self.FORMAT != 'rpm':
+            self.plan_dedup(plan)
+        self.plan_cds(plan, [home])
+    
+    def plan_current(self, current_state, version):
+        # nothing to install, but the settings of the home may have changed
+        plan = Plan()
+        if current_state == 'none':
+            return plan
+        home = self.java_home(version, current_state == 'jdk')
+        self.plan_home(plan, home)
+        if plan or self.env_pending(home):
+            plan.add('env', home)
+        return plan
+    
+    def plan_cds(self, plan, homes):
+        module = self.module
+        if not module.params.get('cds'):
+            return
+        lists = module.params.get('cds_class_lists') or []
+        for home in homes:
+            if JavaCds.stale(home, lists):
+                plan.add('cds', home)
+    
+    def plan_dedup(self, plan):
+        # only homes not indexed yet are hashed, so only those are planned for
+        mode = self.module.params.get('dedup')
+        if not mode or mode == 'none':
+            return
+        if plan.targets('fetch') or plan.targets('install') \
+                or Deduplicator(self.DEDUP_FILE, mode).pending(self.dedup_homes()):
+            plan.add('dedup', self.JAVA_HOME)
+    
+    def plan_install(self, plan, state, version):
+        jdk = state == 'jdk'
+        rpm = self.FORMAT == 'rpm'
+        home = self.java_home(version, jdk)
+        if rpm or not os.path.exists(home) or plan.has('purge', self.JAVA_HOME):
+            plan.add('fetch', (state, version, rpm))
+        if plan or self.env_pending(home):
+            plan.add('env', home)
+    
+    def plan_uninstall(self, plan, purge=False):
+        if purge:
+            plan.add('purge', self.JAVA_HOME)
+        plan.add('env', None)
+    
+    def install_home(self, kind, version, rpm=False):
+        # fetches and extracts a package, without touching the env
         module = self.module
         distro = self.distro
-        jdk = state=='jdk'
+        jdk = kind == 'jdk'
+        images = None if rpm else self.image_cache(module)
+        if images is not None:
+            digest = self.known_digest(module, version, jdk)
+            home = self.tarball_home(version, jdk)
+            if digest is not None and not os.path.exists(home):
+                with Metrics.timer(module, 'image'):
+                    image = images.materialize(digest, home)
+                if image is not None:
+                    self.images.append(image)
+                    return home
+        dest = None
+        if module.params.get('stream') and not rpm:
+            dest = self.stream_package(module, distro, version, jdk, self.JAVA_HOME, self.downloads, self.extractions)
+        if dest is None:
+            source = self.fetch_package(module, distro, version, jdk, rpm, self.JAVA_HOME, self.downloads)
+            dest = self.extract_package(module, distro, source, self.JAVA_HOME, self.extractions)
+        if images is not None:
+            digest = self.known_digest(module, version, jdk)
+            if digest is not None:
+                with Metrics.timer(module, 'image'):
+                    images.add(digest, dest)
+        return dest
+    
+    def execute_remove(self, names):
+        return bool(self.packages.uninstall(names))
+    
+    def execute_install(self, names):
+        return bool(self.packages.install(names))
+    
+    def execute_purge(self, homes):
         changed = False
-        
-        # fetch and extract source
-        destdir = self.JAVA_HOME
-        if not os.path.isdir(destdir):
+        for home in homes:
+            changed = JavaEnv.remove_alternatives(self.module, self.distro, [home]) or changed
+            if os.path.exists(home):
+                # deleted once the run is done
+                Trash.move(home)
+                changed = True
+        return changed
+    
+    def execute_fetch(self, targets):
+        module = self.module
+        changed = False
+        if not os.path.isdir(self.JAVA_HOME):
             o755 = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
-            os.makedirs(destdir, o755)
-            changed = True
-        source = self.fetch_package(module, distro, version, jdk, rpm, destdir)
-        dest = self.extract_package(module, distro, source, destdir)
-        if dest != source:
+            os.makedirs(self.JAVA_HOME, o755)
             changed = True
+        if len(targets) == 1:
+            kind, version, rpm = targets[0]
+            self.package = (version, kind == 'jdk', rpm)
         
-        # install package
-        if rpm:
-            changed = self.packages.install(dest) or changed
+        def fetch(target):
+            kind, version, rpm = target
+            if rpm:
+                # the downloaded package is installed, not extracted
+                dest = self.install_home(kind, version, rpm)
+                return bool(self.packages.install(dest))
+            home = self.tarball_home(version, kind == 'jdk')
+            existed = os.path.exists(home)
+            dest = self.install_home(kind, version)
+            assert dest == home, (dest, home)
+            return not existed
         
-        # update env
-        home = self.java_home(version, jdk)
-        changed = JavaEnv.install(module, distro, home) or changed
+        workers = min(max(int(module.params.get('workers') or 1), 1), len(targets))
+        if workers > 1 and not [t for t in targets if t[2]]:
+            pool = ThreadPool(workers)
+            try:
+                fetched = pool.map(fetch, targets)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fetched = [fetch(target) for target in targets]
         
-        return changed
+        images = self.image_cache(module)
+        cache = self.artifact_cache(module)
+        if images is not None and cache is not None:
+            # images live as long as their packages are known
+            digests = set([a['digest'] for a in cache.load()['artifacts'].values()])
+            digests.update([e['sha256'] for e in self.catalog(module).entries if e['sha256']])
+            images.prune(digests)
+        return bool([f for f in fetched if f]) or changed
     
-    def uninstall(self, purge=False):
+    def execute_dedup(self, roots):
         module = self.module
-        distro = self.distro
+        dedup = Deduplicator(self.DEDUP_FILE, module.params['dedup'], int(module.params.get('extract_workers') or 1))
+        with Metrics.timer(module, 'dedup'):
+            result = dedup.run(self.dedup_homes())
+        self.dedups.append(result)
+        return result['files'] > 0
+    
+    def execute_cds(self, homes):
+        lists = self.module.params.get('cds_class_lists') or []
         changed = False
-        if purge:
-            home = self.JAVA_HOME
-            if os.path.exists(home):
-                shutil.rmtree(home)
-                changed = True
-        changed = JavaEnv.uninstall(module, distro) or changed
+        for home in homes:
+            result = JavaCds.install(self.module, home, lists)
+            changed = result.pop('changed') or changed
+            self.cds.append(result)
         return changed
     
+    def execute_env(self, homes):
+        # the last home planned wins, and None clears the env
+        home = homes[-1]
+        if home is None:
+            return JavaEnv.uninstall(self.module, self.distro, managed=self.managed_homes(),
+                                     owned=self.owned_options())
+        # a clear followed by a set is one write, dropping the other homes' alternatives
+        return JavaEnv.install(self.module, self.distro, home, None in homes, self.managed_homes(),
+                               self.owned_options())
+    
+    def owned_options(self):
+        # whether the last recorded run set JAVA_TOOL_OPTIONS, which is
+        # then cleared once neither option manages it
+        params = (self.load_manifest() or {}).get('params') or {}
+        return params.get('java_tool_options') is not None or params.get('ergonomics') == 'env'
+    
+    def env_pending(self, home):
+        return JavaEnv.pending(self.module, self.distro, home, self.owned_options())
+    
+    def managed_homes(self):
+        # homes this module installed, now or by an earlier run
+        homes = self.tarball_homes()
+        homes.extend([self.java_home(version, jdk) for jdk, version in sorted(self.versions.items())
+                      if version and self.java_home(version, jdk) not in homes])
+        previous = self.load_manifest() or {}
+        if previous.get('result'):
+            homes.extend([h for h in self.result_homes(previous['result']) if h not in homes])
+        return homes
+    
+    def installed_version(self, jdk=False):
+        # memoized until the installation changes
+        if jdk not in self.versions:
+            with Metrics.timer(self.module, 'discovery'):
+                self.versions[jdk] = self.discover_version(self.module, jdk)
+        return self.versions[jdk]
+    
+    @staticmethod
+    def result_homes(result):
+        homes = [result['java_home']]
+        homes.extend([h['java_home'] for h in result.get('homes', [])
+                      if h['java_home'] not in homes])
+        return [h for h in homes if h]
+    
+    def fingerprint(self, homes):
+        # cheap, fork-free summary of what a converged host looks like
+        files = {}
+        paths = [self.distro.ENV_FILE,
+                 os.path.join(self.distro.ALTERNATIVES_DIR, JavaEnv.ALTERNATIVES_GROUPS[0])]
+        for home in homes:
+            paths.extend([home, os.path.join(home, self.RELEASE_FILE)])
+        # new packages in a mirror or releases in a catalog may change what is installed
+        if self.mirror(self.module) is not None:
+            paths.append(self.module.params['package_location'])
+        if self.module.params.get('catalog'):
+            paths.append(self.module.params['catalog'])
+        # a changed class list or library, or a lost archive, needs another dump
+        if self.module.params.get('cds'):
+            lists = self.module.params.get('cds_class_lists') or []
+            paths.extend(lists)
+            for home in homes:
+                for archive, classlist in JavaCds.archives(home, lists):
+                    paths.extend([archive, os.path.join(os.path.dirname(archive), JavaCds.LIBRARY_FILE)])
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                files[path] = None
+            else:
+                files[path] = [st.st_mtime, st.st_size, st.st_ino]
+        bins = {}
+        for prog in ('java', 'javac',):
+            path = self.module.get_bin_path(prog)
+            bins[prog] = os.path.realpath(path) if path else None
+        fingerprint = {'files': files, 'bins': bins}
+        # limits of the host may change while no file does
+        if self.module.params.get('ergonomics') == 'env':
+            fingerprint['ergonomics'] = Ergonomics.profile(self.module)
+        return fingerprint
+    
+    def load_manifest(self):
+        try:
+            with open(self.MANIFEST_FILE, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    
+    def save_manifest(self, result):
+        manifest = {
+            'params': self.module.params,
+            'result': dict([(k, result[k]) for k in ('state', 'version', 'java_home', 'homes',)
+                            if k in result]),
+            'digest': self.package_digest(),
+            'env': {JavaEnv.ENV_VAR: result['java_home']},
+            'fingerprint': self.fingerprint(self.result_homes(result)),
+        }
+        previous = self.load_manifest()
+        if manifest['digest'] is None and previous is not None \
+                and previous.get('result') == manifest['result']:
+            manifest['digest'] = previous.get('digest')
+        if manifest == previous:
+            return False
+        AtomicFile.write_json(self.MANIFEST_FILE, manifest, AtomicFile.PRIVATE)
+        return True
+    
+    def package_digest(self):
+        if self.package is None:
+            return None
+        cache = self.artifact_cache(self.module)
+        if cache is None:
+            return None
+        return cache.known_digest(self.package_key(cache, *self.package))
+    
+    def settled(self, result):
+        # whether the settings the manifest vouches for were all applied,
+        # from the same cheap reads that plan them
+        homes = self.result_homes(result)
+        if not homes:
+            return True
+        plan = Plan()
+        if self.FORMAT != 'rpm' or self.module.params.get('versions'):
+            self.plan_dedup(plan)
+        self.plan_cds(plan, homes)
+        return not plan and not self.env_pending(result['java_home'])
+    
+    def converged(self):
+        # the result recorded by the last run, if nothing changed since
+        manifest = self.load_manifest()
+        if manifest is None or manifest.get('params') != self.module.params:
+            return None
+        # a remote catalog cannot be checked for changes without fetching it
+        catalog = self.module.params.get('catalog')
+        if catalog and not catalog.startswith('/'):
+            return None
+        result = manifest['result']
+        if manifest.get('fingerprint') != self.fingerprint(self.result_homes(result)):
+            return None
+        result['changed'] = False
+        return result
+    
     def apply(self):
+        start = time.time()
+        with Metrics.timer(self.module, 'discovery'):
+            result = self.converged()
+        if result is None:
+            result = self.converge()
+            if not self.module.check_mode and self.settled(result):
+                self.save_manifest(result)
+        if not self.module.check_mode:
+            self.sweep()
+        if self.module.params.get('ergonomics') == 'env' and result.get('java_home'):
+            result['ergonomics'] = Ergonomics.profile(self.module)
+        result['metrics'] = self.metrics(time.time() - start)
+        path = self.module.params.get('metrics_file')
+        if path and not self.module.check_mode:
+            # replaced whole, so the collector never reads a partial file
+            AtomicFile.write(path, Metrics.textfile(result['metrics'], result['changed']))
+        return result
+    
+    def trash_dirs(self):
+        dirnames = [self.JAVA_HOME, os.path.dirname(self.JAVA_HOME)]
+        images = self.image_cache(self.module)
+        if images is not None:
+            dirnames.append(images.root)
+        return dirnames
+    
+    def sweep(self):
+        # removed homes, including any a previous run left behind
+        dirnames = self.trash_dirs()
+        if self.module.params.get('delete_in_background'):
+            if Trash.sweep_detached(dirnames):
+                return
+        with Metrics.timer(self.module, 'delete'):
+            Trash.sweep(dirnames)
+    
+    def metrics(self, seconds):
+        module = self.module
+        metrics = {
+            'seconds': round(seconds, 3),
+            'phases': {},
+            'bytes_downloaded': sum([d.get('bytes', 0) for d in self.downloads]),
+            'bytes_extracted': sum([e.get('bytes', 0) for e in self.extractions]),
+            'files_extracted': sum([e.get('files', 0) for e in self.extractions]),
+            'bytes_reclaimed': sum([d['bytes'] for d in self.dedups]),
+            'commands': {},
+        }
+        if isinstance(module, CommandRunner):
+            metrics['phases'] = module.metrics.report()
+            metrics['commands'] = module.report()
+        return metrics
+    
+    def converge_versions(self):
+        module = self.module
+        targets = []
+        for target in module.params['versions']:
+            target = self.parse_target(module, target)
+            if target not in targets:
+                targets.append(target)
+        if not targets:
+            raise ValueError('No Java versions requested')
+        default = targets[0]
+        if module.params.get('default'):
+            default = self.parse_target(module, module.params['default'])
+            if default not in targets:
+                raise ValueError('Default %s is not in versions' % module.params['default'])
+        homes = [self.tarball_home(version, kind == 'jdk') for kind, version in targets]
+        missing = [(target, home) for target, home in zip(targets, homes)
+                   if not os.path.exists(home)]
+        
+        # homes installed by an earlier run that are no longer wanted
+        previous = self.load_manifest() or {}
+        stale = [h['java_home'] for h in previous.get('result', {}).get('homes', [])
+                 if h['java_home'] not in homes and os.path.exists(h['java_home'])]
+        
+        default_home = homes[targets.index(default)]
+        result = {
+            'changed': False,
+            'state': default[0],
+            'version': default[1].version_string(),
+            'java_home': default_home,
+            'homes': [{'state': kind, 'version': version.version_string(), 'java_home': home}
+                      for (kind, version), home in zip(targets, homes)],
+        }
+        
+        plan = Plan()
+        for home in stale:
+            plan.add('purge', home)
+        for (kind, version), home in missing:
+            plan.add('fetch', (kind, version, False))
+        self.plan_dedup(plan)
+        self.plan_cds(plan, homes)
+        if plan or self.env_pending(default_home):
+            plan.add('env', default_home)
+        
+        if module.check_mode:
+            result['changed'] = bool(plan)
+            result['plan'] = plan.describe()
+            return result
+        
+        result['changed'] = plan.execute(self)
+        self.versions.clear()
+        module.invalidate()
+        self.report(result)
+        return result
+    
+    def report(self, result):
+        # what the executed steps did, under the keys of the result
+        for key, entries in (('downloads', self.downloads),
+                             ('extractions', self.extractions),
+                             ('dedup', self.dedups),
+                             ('images', self.images),
+                             ('cds', self.cds),):
+            if entries:
+                result[key] = entries
+    
+    def converge(self):
         module = self.module
+        if module.params.get('versions'):
+            return self.converge_versions()
 
         current_state = 'none'
-        current_version = self.discover_version(module, True)
+        current_version = self.installed_version(True)
         if current_version:
             current_state = 'jdk'
         else:
-            current_version = self.discover_version(module, False)
+            current_version = self.installed_version(False)
             if current_version:
                 current_state = 'jre'
         
@@ -639,34 +3744,35 @@ class Java(object):
             target_version = JavaVersion(7, 0, 0, 0)
         
         # are we done?
-        if current_state == target_state:
-            # check version
-            if current_state != 'none':
-                if current_version >= target_version:
-                    return result
-            else:
-                return result
-        
-        # short circuit for check mode
-        if module.check_mode:
-            result['changed'] = True
-            current_version = target_version
+        if current_state == target_state \
+                and (current_state == 'none' or current_version >= target_version):
+            latest = current_version
+            plan = self.plan_current(current_state, current_version)
         else:
-            # uninstall existing java
-            if current_state != 'none':
-                result['changed'] = self.uninstall() or result['changed']
-                current_version = self.discover_version(module, current_state == 'jdk')
-                assert not current_version, current_version
-                        
+            latest = None
             if target_state != 'none':
                 # bump target version up to latest version
-                if target_version.major not in self.LATEST_VERSION:
-                    raise NotImplementedError
-                result['changed'] = self.install(target_state, self.LATEST_VERSION[target_version.major]) or result['changed']
-                current_version = self.discover_version(module, target_state == 'jdk')
+                latest = self.resolve_version(module, target_version, target_state == 'jdk', self.FORMAT == 'rpm')
+            plan = self.plan(current_state, target_state, latest)
+        
+        # check mode reports the plan instead of running it
+        if module.check_mode:
+            result['changed'] = bool(plan)
+            result['plan'] = plan.describe()
+            current_version = latest
+        elif plan:
+            result['changed'] = plan.execute(self) or result['changed']
+            self.versions.clear()
+            module.invalidate()
+            if target_state != 'none':
+                current_version = self.installed_version(target_state == 'jdk')
                 assert current_version and current_version >= target_version, current_version
+            else:
+                current_version = self.installed_version(current_state == 'jdk')
+                assert not current_version, current_version
         
         result['state'] = target_state
+        self.report(result)
         result['version'] = current_version.version_string() if current_version else ''
         result['java_home'] = self.java_home(current_version, target_state == 'jdk') if current_version else ''
         
@@ -686,7 +3792,12 @@ class JavaDeb(Java):
     # FOR JRE 7
     JRE_REPO = 'deb http://www.duinsoft.nl/pkg debs all'
     JRE_REPO_KEY = '5CB26B26'
-    JRE_REPO_FILE = '/etc/apt/sources.list.d/duinsoft.list'
+    JRE_REPO_LIST = 'duinsoft.list'
+    
+    def __init__(self, module, distro):
+        super(JavaDeb, self).__init__(module, distro)
+        self.repositories = AptRepository(module, distro, self.packages)
+        self.jre_repo_file = os.path.join(distro.APT_SOURCES_DIR, self.JRE_REPO_LIST)
     
     @classmethod
     def java_home(cls, version, jdk=False):
@@ -704,88 +3815,106 @@ class JavaDeb(Java):
             return 'update-sun-jre'
         return name
 
-    def install_jdk(self, version):
-        changed = False
-        repo = self.JDK_REPO
-        aptrepo = AptRepository(self.module)
-        changed = aptrepo.install(repo) or changed
-        pkg = self.java_package(version, True)
-        if not self.packages.installed(pkg):
-            # accept Oracle license
-            args = " | ".join(("echo %s shared/accepted-oracle-license-v1-1 select true" % pkg,
-                               "/usr/bin/debconf-set-selections"))
-            self.module.run_command(args, True)
-        changed = self.packages.install(pkg) or changed
-        return changed
+    def plan(self, current_state, target_state, version=None):
+        # every package either way is resolved by one query
+        majors = self.catalog(self.module).majors()
+        self.packages.prefetch([self.java_package(JavaVersion(major), jdk)
+                                for major in majors for jdk in (True, False)])
+        plan = super(JavaDeb, self).plan(current_state, target_state, version)
+        # one update, after every change to the sources and before any install
+        for action in ('remove_repository', 'remove_source', 'remove_key', 
+                       'repository', 'source', 'key', 'install',):
+            if plan.targets(action):
+                plan.add('update')
+                break
+        return plan
     
-    def uninstall_jdk(self):
-        changed = False
-        for version in self.arguments['version']['choices']:
-            pkg = self.java_package(JavaVersion.from_string(version), True)
-            changed = self.packages.uninstall(pkg) or changed
-        repo = self.JDK_REPO
-        aptrepo = AptRepository(self.module)
-        changed = aptrepo.uninstall(repo) or changed
-        return changed
-        
-    def install_jre(self, version):
-        changed = False
-        if version.major == 7:
-            if not os.path.isfile(self.JRE_REPO_FILE):
-                with open(self.JRE_REPO_FILE, 'w') as f:
-                    f.write(self.JRE_REPO)
-                    f.write('\n')
-                changed = True
-
-            changed = AptKey.install(self.module, self.JRE_REPO_KEY) or changed
-            if changed:
-                self.packages.update()
-            
-            pkg = self.java_package(version, False)
-            changed = self.packages.install(pkg) or changed
+    def plan_install(self, plan, state, version):
+        jdk = state == 'jdk'
+        if jdk:
+            repo = self.JDK_REPO
+            if plan.has('remove_repository', repo) or not self.repositories.installed(repo):
+                plan.add('repository', repo)
+        elif version.major == 7:
+            if plan.has('remove_source', self.jre_repo_file) or not os.path.isfile(self.jre_repo_file):
+                plan.add('source', self.jre_repo_file)
+            key = self.JRE_REPO_KEY
+            if plan.has('remove_key', key) or not AptKey.installed(self.module, self.distro, key):
+                plan.add('key', key)
         else:
             raise NotImplementedError
+        pkg = self.java_package(version, jdk)
+        if plan.has('remove', pkg) or not self.packages.installed(pkg):
+            plan.add('install', pkg)
+            if jdk and plan.has('install', pkg):
+                # accept Oracle license
+                plan.add('debconf', pkg)
+        home = self.java_home(version, jdk)
+        if plan or self.env_pending(home):
+            plan.add('env', home)
+    
+    def plan_uninstall(self, plan, purge=False):
+        for major in self.catalog(self.module).majors():
+            for jdk in (True, False):
+                pkg = self.java_package(JavaVersion(major), jdk)
+                if self.packages.installed(pkg):
+                    plan.add('remove', pkg)
+        if self.repositories.installed(self.JDK_REPO):
+            plan.add('remove_repository', self.JDK_REPO)
+        if os.path.isfile(self.jre_repo_file):
+            plan.add('remove_source', self.jre_repo_file)
+        if AptKey.installed(self.module, self.distro, self.JRE_REPO_KEY):
+            plan.add('remove_key', self.JRE_REPO_KEY)
+        super(JavaDeb, self).plan_uninstall(plan, purge)
+    
+    def execute_repository(self, repos):
+        changed = False
+        for repo in repos:
+            changed = self.repositories.install(repo) or changed
         return changed
-        
-    def uninstall_jre(self):
+    
+    def execute_remove_repository(self, repos):
         changed = False
-        for version in self.arguments['version']['choices']:
-            pkg = self.java_package(JavaVersion.from_string(version), False)
-            changed = self.packages.uninstall(pkg) or changed
-        
-        if os.path.isfile(self.JRE_REPO_FILE):
-            os.remove(self.JRE_REPO_FILE)
-            changed = True
-            self.packages.update()
-
-        changed = AptKey.uninstall(self.module, self.JRE_REPO_KEY) or changed
-        changed = super(JavaDeb, self).uninstall() or changed
+        for repo in repos:
+            changed = self.repositories.uninstall(repo) or changed
         return changed
     
-    def install(self, state, version):
-        module = self.module
-        distro = self.distro
+    def execute_source(self, paths):
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write(self.JRE_REPO)
+                f.write('\n')
+        return True
+    
+    def execute_remove_source(self, paths):
+        for path in paths:
+            os.remove(path)
+        return True
+    
+    def execute_key(self, keys):
         changed = False
-        
-        self.packages.update()
-        jdk = state == 'jdk'
-        if jdk:
-            changed = self.install_jdk(version) or changed
-        else:
-            changed = self.install_jre(version) or changed
-        home = self.java_home(version, jdk)
-        changed = JavaEnv.install(module, distro, home) or changed
+        for key in keys:
+            changed = AptKey.install(self.module, self.distro, key, self.module.params.get('apt_key_file')) or changed
         return changed
-        
-    def uninstall(self):
-        module = self.module
-        distro = self.distro
+    
+    def execute_remove_key(self, keys):
         changed = False
-        changed = self.uninstall_jdk() or changed
-        changed = self.uninstall_jre() or changed
-        changed = JavaEnv.uninstall(module, distro) or changed
+        for key in keys:
+            changed = AptKey.uninstall(self.module, self.distro, key) or changed
         return changed
     
+    def execute_update(self, targets):
+        self.packages.update()
+        self.packages.refresh()
+        return False
+    
+    def execute_debconf(self, names):
+        selections = ["'%s shared/accepted-oracle-license-v1-1 select true'" % name for name in names]
+        args = " | ".join(("printf '%%s\\n' %s" % ' '.join(selections),
+                           os.path.join(self.distro.BIN_DIR, 'debconf-set-selections')))
+        self.module.run_command(args, True)
+        return False
+    
 #############################################################################
 #############################################################################
 
@@ -795,21 +3924,17 @@ class JavaRhel(Java):
     # https://github.com/p120ph37/java-1.7.0-sun-compat
     
     JAVA_HOME = '/usr/java'
+    FORMAT = 'rpm'
     
     @classmethod
     def java_home(cls, version=None, jdk=False):
         return os.path.join(cls.JAVA_HOME, 'default')
 
-    def install(self, state, version):
-        return super(JavaRhel, self).install(state, version, True)
-        
-    def uninstall(self):
-        changed = False
-        pkgs = ['jdk', 'jre']
-        for pkg in pkgs:
-            changed = self.packages.uninstall(pkg) or changed
-        changed = JavaEnv.uninstall(self.module, self.distro) or changed
-        return changed
+    def plan_uninstall(self, plan, purge=False):
+        for pkg in ('jdk', 'jre',):
+            if self.packages.installed(pkg):
+                plan.add('remove', pkg)
+        super(JavaRhel, self).plan_uninstall(plan, purge)
 
 #############################################################################
 # Distribution details
@@ -817,7 +3942,8 @@ class JavaRhel(Java):
 
 class Distribution(object):
     ENV_FILE = '/etc/environment'
-    DOWNLOAD_CMD = 'wget'
+    BIN_DIR = '/usr/bin'
+    ALTERNATIVES_LINK_DIR = '/etc/alternatives'
     
     Java = Java
     supported = {}
@@ -836,34 +3962,47 @@ class Distribution(object):
         return subcls
 
     @classmethod
-    def download(cls, module, source, opts=None, destfile=None, destdir=None):
+    def downloader(cls, module, headers=None):
+        params = module.params
+        return Downloader(headers,
+                          connections=int(params.get('download_connections') or 1),
+                          retries=int(params.get('download_retries') or 1),
+                          timeout=int(params.get('download_timeout') or 60))
+    
+    @classmethod
+    def download(cls, module, source, headers=None, destfile=None, destdir=None, size=None, stats=None):
         if destdir is None:
             destdir = tempfile.gettempdir()
         if destfile is None:
             destfile = source.rsplit('/', 1)[1]
         dest = os.path.join(destdir, destfile)
         
-        if opts is None:
-            opts = ('-c', '--no-cookies')
-        
-        argv = [cls.DOWNLOAD_CMD]
-        argv.extend(opts)
-        argv.append(source)
-        argv.append('--output-document=%s' % dest)
-        result = module.run_command(argv)
-        if result[0] != 0:
-            raise RuntimeError('Error: Download returned %d: %s' % (result[0], argv))
+        downloader = cls.downloader(module, headers)
+        try:
+            result = downloader.download(source, dest, size)
+        except (IOError, httplib.HTTPException) as e:
+            raise RuntimeError('Error: Download of %s failed: %s' % (source, e))
+        if stats is not None:
+            stats.append(result)
         
         return dest
 
 class DebDistribution(Distribution):
     ALTERNATIVES_CMD = 'update-alternatives'
+    ALTERNATIVES_DIR = '/var/lib/dpkg/alternatives'
+    APT_SOURCES_FILE = '/etc/apt/sources.list'
+    APT_SOURCES_DIR = '/etc/apt/sources.list.d'
+    APT_KEYRING = '/etc/apt/trusted.gpg'
+    APT_KEYRING_DIR = '/etc/apt/trusted.gpg.d'
+    APT_UPDATE_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+    APT_LISTS_DIR = '/var/lib/apt/lists'
     PackageManager = Apt
     Java = JavaDeb
 super(DebDistribution, DebDistribution).supported[('Ubuntu',)] = DebDistribution
 
 class RhelDistribution(Distribution):
     ALTERNATIVES_CMD = 'alternatives'
+    ALTERNATIVES_DIR = '/var/lib/alternatives'
     PackageManager = Yum
     Java = JavaRhel
 super(RhelDistribution, RhelDistribution).supported[('Fedora',)] = RhelDistribution
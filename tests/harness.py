@@ -0,0 +1,350 @@
+"""Scratch hosts that run java.py offline.
+
+A Host is a temporary directory standing in for /. Every absolute path
+of its distribution and Java classes is moved under it, the package and
+alternatives commands in its usr/bin are the stubs of stubs.py, and the
+packages it offers are served by a local HTTP Server. Runs go through
+Module, a stand-in for AnsibleModule that forks every command for real
+and counts the forks.
+"""
+
+import io
+import os
+import sys
+import json
+import stat
+import types
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+import stubs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE_FILE = os.path.join(os.path.dirname(HERE), 'java.py')
+
+_java = None
+
+
+def load_module():
+    # java.py ends by running itself, as Ansible expects
+    global _java
+    if _java is None:
+        with open(MODULE_FILE, 'r') as f:
+            source = f.read().rsplit('\nmain()', 1)[0]
+        _java = types.ModuleType('java')
+        _java.__file__ = MODULE_FILE
+        exec(compile(source, MODULE_FILE, 'exec'), _java.__dict__)
+    return _java
+
+#############################################################################
+#############################################################################
+
+class ModuleFailed(Exception):
+    pass
+
+
+class Module(object):
+    """Just enough of AnsibleModule for java.py."""
+
+    def __init__(self, host, params, check_mode=False):
+        java = load_module()
+        self.host = host
+        self.params = dict([(k, v.get('default')) for k, v in java.Java.arguments.items()])
+        self.params.update(params)
+        self.check_mode = check_mode
+        self.forks = 0
+        self.commands = []
+
+    def run_command(self, args, check_rc=False, cwd=None, **kwargs):
+        self.forks += 1
+        self.commands.append(args)
+        process = subprocess.Popen(args, shell=isinstance(args, basestring), cwd=cwd,
+                                   env=self.host.env(), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if check_rc and process.returncode != 0:
+            self.fail_json(msg=err or out, rc=process.returncode, cmd=args)
+        return process.returncode, out, err
+
+    def get_bin_path(self, name, required=False, opt_dirs=None):
+        # only the host's own, never the machine's
+        path = os.path.join(self.host.distro.BIN_DIR, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+        if required:
+            self.fail_json(msg='Failed to find required executable %s' % name)
+        return None
+
+    def fail_json(self, **kwargs):
+        raise ModuleFailed(kwargs.get('msg'))
+
+#############################################################################
+#############################################################################
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        header = self.headers.getheader('Range')
+        if header:
+            first, last = header.split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+        with self.server.lock:
+            self.server.sent += end - start + 1
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves files from memory, counting the bytes it sends."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.files = {}
+        self.sent = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, path, data):
+        self.files[path] = data
+        return 'http://%s:%d%s' % (self.server_address + (path,))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+#############################################################################
+#############################################################################
+
+# enough of a launcher to dump and report class data sharing archives
+JAVA_SCRIPT = '''#!/bin/sh
+server="$(dirname "$0")/../jre/lib/amd64/server"
+archive="$server/classes.jsa"
+for arg in "$@"; do
+    case "$arg" in
+        -Xshare:dump) dump=1 ;;
+        -Xshare:off) off=1 ;;
+        -XX:SharedArchiveFile=*) archive="${arg#*=}" ;;
+    esac
+done
+if [ -n "$dump" ]; then
+    echo "archive of %(java)s" > "$archive"
+    exit 0
+fi
+mode="mixed mode"
+if [ -z "$off" ] && [ -f "$server/classes.jsa" ]; then
+    mode="$mode, sharing"
+fi
+echo 'java version "%(java)s"' >&2
+echo "Java HotSpot(TM) 64-Bit Server VM (build 24.76-b04, $mode)" >&2
+'''
+
+
+def tarball(name, java, kind, files=40, size=64 << 10):
+    # a home that looks enough like an Oracle one, with a few large jars
+    buf = io.BytesIO()
+    archive = tarfile.open(fileobj=buf, mode='w:gz')
+
+    def add(path, data=None, mode=0o644):
+        info = tarfile.TarInfo(os.path.join(name, path) if path else name)
+        info.mtime = 1400000000
+        info.mode = mode
+        if data is None:
+            info.type = tarfile.DIRTYPE
+            archive.addfile(info)
+        else:
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    add('', mode=0o755)
+    add('bin', mode=0o755)
+    add('bin/java', (JAVA_SCRIPT % {'java': java}).encode(), 0o755)
+    tools = ['keytool'] + (['javac', 'jar'] if kind == 'jdk' else [])
+    for tool in tools:
+        add('bin/' + tool, b'#!/bin/sh\necho \'' + tool.encode() + b' "' + java.encode() + b'"\' >&2\n', 0o755)
+    add('lib/security', mode=0o755)
+    add('lib/security/cacerts', b'certificates of ' + name.encode())
+    add('jre/lib/amd64/server', mode=0o755)
+    add('jre/lib/amd64/server/libjvm.so', hashlib.sha256(java.encode()).digest() * 64)
+    # Oracle 7 releases leave out the update
+    add('release', b'JAVA_VERSION="1.7.0"\n')
+    add('lib', mode=0o755)
+    for i in range(files):
+        seed = hashlib.sha256(('%s %d' % (name, i)).encode()).digest()
+        add('lib/f%d' % i, seed * (1 + i * 8))
+    for jar in ('rt.jar', 'charsets.jar'):
+        add('lib/' + jar, hashlib.sha256(jar.encode()).digest() * (size // 32))
+    archive.close()
+    return buf.getvalue()
+
+#############################################################################
+#############################################################################
+
+class Host(object):
+    """A scratch root for one distribution, offering Java releases."""
+
+    def __init__(self, distro, server):
+        java = load_module()
+        self.java = java
+        self.server = server
+        self.root = tempfile.mkdtemp(prefix='ansible-java-bench-')
+        self.releases = []
+        self.available = {}
+
+        base = {'deb': java.DebDistribution, 'rhel': java.RhelDistribution}[distro]
+        # every absolute path of the distro and its Java, moved under root
+        self.distro = type('Host' + base.__name__, (base,), self.rebase(base))
+        attrs = self.rebase(base.Java)
+        attrs['catalogs'] = {}
+        if distro == 'deb':
+            # the test key stands in for the repository's
+            key = os.path.join(HERE, 'data', 'repo-key.asc')
+            with open(key, 'rb') as f:
+                attrs['JRE_REPO_KEY'] = java.AptKey.fingerprints(f.read())[0][-8:]
+        self.distro.Java = type('Host' + base.Java.__name__, (base.Java,), attrs)
+
+        for path in (self.distro.ENV_FILE,):
+            self.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        for name in ('BIN_DIR', 'ALTERNATIVES_LINK_DIR', 'ALTERNATIVES_DIR',
+                     'APT_SOURCES_DIR', 'APT_KEYRING_DIR', 'APT_LISTS_DIR',):
+            if hasattr(self.distro, name):
+                self.makedirs(getattr(self.distro, name))
+        self.makedirs(self.distro.Java.JAVA_HOME)
+        self.install_stubs()
+        self.write_config()
+
+    def rebase(self, cls):
+        attrs = {}
+        for name in dir(cls):
+            value = getattr(cls, name)
+            if name.isupper() and isinstance(value, str) and value.startswith('/'):
+                attrs[name] = self.path(value)
+        return attrs
+
+    def path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    @staticmethod
+    def makedirs(path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def install_stubs(self):
+        for name in stubs.STUBS:
+            path = os.path.join(self.distro.BIN_DIR, name)
+            with open(path, 'w') as f:
+                f.write('#!%s\nimport sys\nsys.path.insert(0, %r)\nimport stubs\n'
+                        'sys.exit(stubs.main(%r, sys.argv[1:]))\n' % (sys.executable, HERE, name))
+            os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+    @property
+    def config_file(self):
+        return self.path('/var/lib/bench/config.json')
+
+    def write_config(self):
+        distro = self.distro
+        stubs.save(self.config_file, {
+            'state_file': self.path('/var/lib/bench/state.json'),
+            'alternatives_dir': distro.ALTERNATIVES_DIR,
+            'link_dir': distro.ALTERNATIVES_LINK_DIR,
+            'sources_dir': getattr(distro, 'APT_SOURCES_DIR', None),
+            'keyring_dir': getattr(distro, 'APT_KEYRING_DIR', None),
+            'update_stamp': getattr(distro, 'APT_UPDATE_STAMP', None),
+            'repo_key': os.path.join(HERE, 'data', 'repo-key.asc'),
+            'available': self.available,
+        })
+
+    def env(self):
+        env = dict(os.environ)
+        env['PATH'] = '%s:%s' % (self.distro.BIN_DIR, env.get('PATH', '/usr/bin:/bin'))
+        env['BENCH_CONFIG'] = self.config_file
+        return env
+
+    @property
+    def catalog(self):
+        return self.path('/etc/ansible-java/catalog.json')
+
+    def offer(self, kind, update):
+        # a release as a tarball, an rpm and a distribution package
+        Java = self.distro.Java
+        version = self.java.JavaVersion(7, 0, update)
+        java = version.version_string()
+        name = '%s%s' % (kind, java)
+        entries = []
+        data = tarball(name, java, kind)
+        entries.append(('tar.gz', data))
+        rpm = {
+            'name': kind,
+            'version': '%s-fcs' % java,
+            'kind': kind,
+            'java': java,
+            'home': os.path.join(Java.JAVA_HOME, name),
+            'links': {os.path.join(Java.JAVA_HOME, 'default'): os.path.join(Java.JAVA_HOME, name)},
+        }
+        entries.append(('rpm', json.dumps(rpm).encode()))
+        for fmt, data in entries:
+            url = self.server.publish('/%s/%s-7u%d.%s' % (os.path.basename(self.root), kind, update, fmt), data)
+            self.releases.append({
+                'version': version.update_string(), 'build': 1, 'arch': Java.discover_arch(),
+                'kind': kind, 'format': fmt, 'url': url, 'size': len(data),
+                'sha256': hashlib.sha256(data).hexdigest(),
+            })
+        if hasattr(Java, 'java_package'):
+            jdk = kind == 'jdk'
+            package = Java.java_package(version, jdk)
+            self.available[package] = {
+                'name': package,
+                'version': '%s-1' % version.update_string(),
+                'kind': kind,
+                'java': java,
+                'home': Java.java_home(version, jdk),
+            }
+        self.makedirs(os.path.dirname(self.catalog))
+        with open(self.catalog, 'w') as f:
+            json.dump(self.releases, f)
+        self.write_config()
+
+    def params(self, **params):
+        defaults = {
+            'catalog': self.catalog,
+            'cache_dir': self.path('/var/cache/ansible-java'),
+            'verify_version': False,
+        }
+        defaults.update(params)
+        return defaults
+
+    def run(self, check_mode=False, **params):
+        # every Ansible run is a process of its own
+        self.distro.Java.catalogs.clear()
+        self.java.MirrorCatalog._scans.clear()
+        self.java.AptKey._signature = self.java.AptKey._index = None
+        module = Module(self, self.params(**params), check_mode)
+        result = self.java.Java.main(module, self.distro)
+        return result, module
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
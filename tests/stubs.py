@@ -0,0 +1,322 @@
+"""Stand-ins for the package and alternatives commands of a host.
+
+Each stub is installed under the name of the command it replaces and
+keeps the state of the scratch host in JSON files named by the config
+that BENCH_CONFIG points to. Packages are JSON descriptions of a Java
+home, which installing creates and removing deletes.
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+
+
+def load(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+
+class Host(object):
+
+    def __init__(self, config):
+        self.config = load(config, {})
+        self.state_file = self.config['state_file']
+        self.state = load(self.state_file, {'packages': {}})
+
+    def save(self):
+        save(self.state_file, self.state)
+
+    @staticmethod
+    def write(path, text, mode=0o644):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, mode)
+
+    def create_home(self, package):
+        home = package['home']
+        version = package['java']
+        tools = {'java': 'java version "%s"' % version, 'keytool': 'keytool'}
+        if package['kind'] == 'jdk':
+            tools.update({'javac': 'javac %s' % version, 'jar': 'jar'})
+        for tool, banner in tools.items():
+            self.write(os.path.join(home, 'bin', tool),
+                       '#!/bin/sh\necho \'%s\' >&2\n' % banner, 0o755)
+        self.write(os.path.join(home, 'release'), 'JAVA_VERSION="%s"\n' % version)
+        self.write(os.path.join(home, 'lib', 'rt.jar'), 'rt' * 4096)
+        for link, target in package.get('links', {}).items():
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(target, link)
+
+    def install(self, package):
+        self.create_home(package)
+        self.state['packages'][package['name']] = package
+
+    def remove(self, name):
+        package = self.state['packages'].pop(name, None)
+        if package is None:
+            return False
+        for link in package.get('links', {}):
+            if os.path.lexists(link):
+                os.remove(link)
+        if os.path.isdir(package['home']):
+            shutil.rmtree(package['home'])
+        return True
+
+    def installed(self, fmt):
+        return dict([(n, p) for n, p in self.state['packages'].items() if p['format'] == fmt])
+
+
+def rpm(host, argv):
+    if argv[:1] == ['-qa']:
+        for name, package in sorted(host.installed('rpm').items()):
+            sys.stdout.write('%s\t%s\n' % (name, package['version']))
+        return 0
+    if argv[:1] == ['-qp']:
+        package = load(argv[-1], None)
+        sys.stdout.write('%s\t%s\n' % (package['name'], package['version']))
+        return 0
+    sys.stderr.write('rpm: unsupported arguments %s\n' % argv)
+    return 1
+
+
+def yum(host, argv):
+    argv = [a for a in argv if not a.startswith('-')]
+    if argv[0] == 'install':
+        for path in argv[1:]:
+            package = load(path, None)
+            if package is None:
+                sys.stderr.write('No package %s available.\n' % path)
+                return 1
+            package['format'] = 'rpm'
+            host.remove(package['name'])
+            host.install(package)
+    elif argv[0] == 'remove':
+        for name in argv[1:]:
+            host.remove(name)
+    host.save()
+    return 0
+
+
+def dpkg_query(host, argv):
+    names = argv[argv.index('-W') + 1:]
+    installed = host.installed('deb')
+    rc = 0
+    for name in names:
+        if name in installed:
+            sys.stdout.write('%s\t%s\tinstall ok installed\n' % (name, installed[name]['version']))
+        else:
+            sys.stderr.write('dpkg-query: no packages found matching %s\n' % name)
+            rc = 1
+    return rc
+
+
+def apt_get(host, argv):
+    args = []
+    value = False
+    for a in argv:
+        # options that take a value
+        if value:
+            value = False
+        elif a in ('--option', '-t'):
+            value = True
+        elif not a.startswith('-'):
+            args.append(a)
+    command, names = args[0], args[1:]
+    if command == 'update':
+        stamp = host.config['update_stamp']
+        Host.write(stamp, '')
+    elif command == 'install':
+        available = host.config.get('available', {})
+        for name in names:
+            if name not in available:
+                sys.stderr.write('E: Unable to locate package %s\n' % name)
+                return 100
+        for name in names:
+            package = dict(available[name])
+            package['format'] = 'deb'
+            host.install(package)
+    elif command == 'remove':
+        for name in names:
+            host.remove(name)
+    host.save()
+    return 0
+
+
+def apt_key(host, argv):
+    keyring = os.path.join(host.config['keyring_dir'], 'bench.asc')
+    if argv[0] == 'adv':
+        shutil.copyfile(host.config['repo_key'], keyring)
+    elif argv[0] == 'del' and os.path.exists(keyring):
+        os.remove(keyring)
+    return 0
+
+
+def add_apt_repository(host, argv):
+    remove = '--remove' in argv
+    repo = [a for a in argv if not a.startswith('-')][-1]
+    owner, name = re.match(r'^ppa:([^/]+)/(.+)$', repo).groups()
+    path = os.path.join(host.config['sources_dir'], '%s-%s.list' % (owner, name))
+    if remove:
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        Host.write(path, 'deb http://ppa.launchpad.net/%s/%s/ubuntu bench main\n' % (owner, name))
+    return 0
+
+
+class Alternatives(object):
+    """Groups in the admin directory format that java.py parses."""
+
+    def __init__(self, host):
+        self.admindir = host.config['alternatives_dir']
+        self.linkdir = host.config['link_dir']
+
+    def load(self, name):
+        path = os.path.join(self.admindir, name)
+        if not os.path.exists(path):
+            return None
+        lines = open(path).read().split('\n')
+        group = {'mode': lines[0], 'link': lines[1], 'slaves': [], 'alternatives': []}
+        i = 2
+        while lines[i]:
+            group['slaves'].append([lines[i], lines[i+1]])
+            i += 2
+        i += 1
+        while i < len(lines) and lines[i]:
+            paths = lines[i+2:i+2+len(group['slaves'])]
+            group['alternatives'].append([lines[i], int(lines[i+1]), paths])
+            i += 2 + len(group['slaves'])
+        return group
+
+    def save(self, name, group):
+        path = os.path.join(self.admindir, name)
+        if not group['alternatives']:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        lines = [group['mode'], group['link']]
+        for slave in group['slaves']:
+            lines.extend(slave)
+        lines.append('')
+        for path_, priority, paths in group['alternatives']:
+            lines.extend([path_, str(priority)] + paths)
+        lines.extend(['', ''])
+        Host.write(path, '\n'.join(lines))
+
+    def link(self, link, name, target):
+        # link -> linkdir/name -> target, as the real tools do
+        managed = os.path.join(self.linkdir, name)
+        for path, dest in ((managed, target), (link, managed)):
+            if os.path.lexists(path):
+                os.remove(path)
+            if dest:
+                dirname = os.path.dirname(path)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                os.symlink(dest, path)
+
+    def select(self, name, group, path):
+        entry = [a for a in group['alternatives'] if a[0] == path][0]
+        self.link(group['link'], name, path)
+        for (slave, link), target in zip(group['slaves'], entry[2]):
+            self.link(link, slave, target or None)
+
+    def current(self, name):
+        managed = os.path.join(self.linkdir, name)
+        return os.readlink(managed) if os.path.islink(managed) else None
+
+    def run(self, argv):
+        action = argv[0]
+        if action == '--install':
+            link, name, path, priority = argv[1:5]
+            slaves = {}
+            rest = argv[5:]
+            while rest:
+                slaves[rest[2]] = (rest[1], rest[3])
+                rest = rest[4:]
+            group = self.load(name) or {'mode': 'auto', 'link': link, 'slaves': [], 'alternatives': []}
+            group['link'] = link
+            known = [s for s, l in group['slaves']]
+            for slave in sorted(slaves):
+                if slave not in known:
+                    group['slaves'].append([slave, slaves[slave][0]])
+                    for entry in group['alternatives']:
+                        entry[2].append('')
+            entry = [path, int(priority), [slaves.get(s, (None, ''))[1] for s, l in group['slaves']]]
+            group['alternatives'] = [a for a in group['alternatives'] if a[0] != path] + [entry]
+            self.save(name, group)
+            if group['mode'] == 'auto':
+                best = sorted(group['alternatives'], key=lambda a: a[1])[-1][0]
+                self.select(name, group, best)
+        elif action == '--set':
+            name, path = argv[1:3]
+            group = self.load(name)
+            group['mode'] = 'manual'
+            self.save(name, group)
+            self.select(name, group, path)
+        elif action == '--remove':
+            name, path = argv[1:3]
+            group = self.load(name)
+            if group is None:
+                return 0
+            group['alternatives'] = [a for a in group['alternatives'] if a[0] != path]
+            self.save(name, group)
+            if not group['alternatives']:
+                self.link(group['link'], name, None)
+                for slave, link in group['slaves']:
+                    self.link(link, slave, None)
+            elif self.current(name) == path:
+                group['mode'] = 'auto'
+                self.save(name, group)
+                self.select(name, group, sorted(group['alternatives'], key=lambda a: a[1])[-1][0])
+        else:
+            sys.stderr.write('alternatives: unsupported arguments %s\n' % argv)
+            return 2
+        return 0
+
+
+def alternatives(host, argv):
+    return Alternatives(host).run(argv)
+
+
+def debconf_set_selections(host, argv):
+    sys.stdin.read()
+    return 0
+
+
+STUBS = {
+    'rpm': rpm,
+    'yum': yum,
+    'dpkg-query': dpkg_query,
+    'apt-get': apt_get,
+    'apt-key': apt_key,
+    'add-apt-repository': add_apt_repository,
+    'alternatives': alternatives,
+    'update-alternatives': alternatives,
+    'debconf-set-selections': debconf_set_selections,
+}
+
+
+def main(name, argv):
+    host = Host(os.environ['BENCH_CONFIG'])
+    return STUBS[name](host, argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,124 @@
+"""Whole runs of java.py against scratch hosts, held to recorded baselines.
+
+Each scenario runs the module offline against a fresh harness.Host and
+measures the run that matters: its wall time, the commands it forked,
+and the bytes it downloaded and extracted. A scenario fails when it
+forks more or moves more bytes than its baseline, or when it is
+several times slower. Run with BENCH_RECORD=1 to record new baselines
+into baselines.json, e.g.
+
+    BENCH_RECORD=1 python -m unittest discover -s tests
+"""
+
+import os
+import json
+import time
+import unittest
+
+import harness
+
+BASELINES_FILE = os.path.join(harness.HERE, 'baselines.json')
+
+# wall time depends on the machine, so only gross slowdowns fail
+SLOWDOWN = 3.0
+SLACK = 1.0
+
+
+class Bench(object):
+
+    distro = None
+    state = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = harness.Server()
+        cls.samples = {}
+        if os.path.exists(BASELINES_FILE):
+            with open(BASELINES_FILE, 'r') as f:
+                cls.baselines = json.load(f)
+        else:
+            cls.baselines = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        if os.environ.get('BENCH_RECORD'):
+            baselines = {}
+            if os.path.exists(BASELINES_FILE):
+                with open(BASELINES_FILE, 'r') as f:
+                    baselines = json.load(f)
+            baselines.setdefault(cls.distro, {}).update(cls.samples)
+            with open(BASELINES_FILE, 'w') as f:
+                json.dump(baselines, f, indent=1, sort_keys=True, separators=(',', ': '))
+                f.write('\n')
+
+    def setUp(self):
+        self.host = harness.Host(self.distro, self.server)
+        self.host.offer(self.state, 76)
+
+    def tearDown(self):
+        self.host.cleanup()
+
+    def measure(self, scenario, **params):
+        start = time.time()
+        result, module = self.host.run(**params)
+        sample = {
+            'seconds': round(time.time() - start, 3),
+            'forks': module.forks,
+            'bytes_downloaded': result['metrics']['bytes_downloaded'],
+            'bytes_extracted': result['metrics']['bytes_extracted'],
+        }
+        self.samples[scenario] = sample
+        baseline = self.baselines.get(self.distro, {}).get(scenario)
+        if baseline is not None and not os.environ.get('BENCH_RECORD'):
+            for key in ('forks', 'bytes_downloaded', 'bytes_extracted',):
+                self.assertLessEqual(sample[key], baseline[key],
+                                     '%s %s: %s rose from %d to %d'
+                                     % (self.distro, scenario, key, baseline[key], sample[key]))
+            limit = baseline['seconds'] * SLOWDOWN + SLACK
+            self.assertLessEqual(sample['seconds'], limit,
+                                 '%s %s: took %.3fs, over %.3fs'
+                                 % (self.distro, scenario, sample['seconds'], limit))
+        return result
+
+    def test_fresh(self):
+        result = self.measure('fresh', state=self.state)
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['version'], '1.7.0_76')
+        self.assertTrue(os.path.isdir(result['java_home']))
+
+    def test_converged(self):
+        self.host.run(state=self.state)
+        result = self.measure('converged', state=self.state)
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['version'], '1.7.0_76')
+
+    def test_upgrade(self):
+        target = '%s:7' % self.state
+        self.host.run(versions=[target])
+        self.host.offer(self.state, 80)
+        result = self.measure('upgrade', versions=[target])
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['version'], '1.7.0_80')
+        self.assertTrue(os.path.isdir(result['java_home']))
+
+    def test_uninstall(self):
+        installed = self.host.run(state=self.state)[0]
+        result = self.measure('uninstall', state='none')
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['version'], '')
+        self.assertFalse(os.path.exists(installed['java_home']))
+
+
+class DebBench(Bench, unittest.TestCase):
+    distro = 'deb'
+    state = 'jre'
+
+
+class RhelBench(Bench, unittest.TestCase):
+    distro = 'rhel'
+    state = 'jdk'
+
+
+if __name__ == '__main__':
+    unittest.main()
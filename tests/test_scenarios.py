@@ -0,0 +1,197 @@
+"""Runs of java.py against scratch hosts that check what they leave behind.
+
+Where test_bench holds whole runs to their costs, these check that
+options and modes take effect, including on hosts that were already
+converged by an earlier run.
+"""
+
+import os
+import stat
+import shutil
+import unittest
+
+import harness
+
+
+class Scenarios(object):
+
+    distro = None
+    state = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = harness.Server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.host = harness.Host(self.distro, self.server)
+        self.host.offer(self.state, 76)
+        self.sent = self.server.sent
+
+    def tearDown(self):
+        self.host.cleanup()
+
+    def env(self):
+        with open(self.host.distro.ENV_FILE, 'r') as f:
+            return f.read()
+
+    @property
+    def target(self):
+        return '%s:7' % self.state
+
+    def package(self, update=76):
+        # the tarball the server holds for a release
+        for entry in self.host.releases:
+            if entry['url'].endswith('-7u%d.tar.gz' % update):
+                return self.server.files['/' + entry['url'].split('/', 3)[3]]
+
+    def files(self, root):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            paths.extend([os.path.join(dirpath, f) for f in filenames])
+        return paths
+
+    def test_stream(self):
+        result = self.host.run(versions=[self.target], stream=True)[0]
+        self.assertTrue(result['changed'])
+        self.assertEqual([d['dest'] for d in result['downloads']], [result['java_home']])
+        self.assertIn('stream', result['metrics']['phases'])
+        self.assertTrue(os.path.isfile(os.path.join(result['java_home'], 'bin', 'java')))
+        # extracted as it arrives, so no package is left behind
+        cache = self.host.params()['cache_dir']
+        self.assertEqual([p for p in self.files(cache) if p.endswith('.tar.gz')], [])
+        result, module = self.host.run(versions=[self.target], stream=True)
+        self.assertFalse(result['changed'])
+        self.assertEqual(module.forks, 0)
+
+    def test_dedup(self):
+        self.host.offer(self.state, 75)
+        versions = ['%s:1.7.0_75' % self.state, '%s:1.7.0_76' % self.state]
+        result = self.host.run(versions=versions, dedup='hardlink')[0]
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['dedup'][0]['homes'], 2)
+        self.assertGreater(result['dedup'][0]['bytes'], 0)
+        self.assertEqual(result['metrics']['bytes_reclaimed'], result['dedup'][0]['bytes'])
+        old, new = [h['java_home'] for h in result['homes']]
+        shared = [p for p in self.files(old)
+                  if os.path.isfile(new + p[len(old):])
+                  and os.stat(p).st_ino == os.stat(new + p[len(old):]).st_ino]
+        self.assertTrue(shared)
+        result, module = self.host.run(versions=versions, dedup='hardlink')
+        self.assertFalse(result['changed'])
+        self.assertEqual(module.forks, 0)
+
+    def test_image_cache(self):
+        home = self.host.run(versions=[self.target], image_cache=True)[0]['java_home']
+        images = os.path.join(self.host.params()['cache_dir'], 'images')
+        image, = [os.path.join(images, d, os.path.basename(home)) for d in os.listdir(images)]
+        for dirpath, dirnames, filenames in os.walk(image):
+            self.assertFalse(os.stat(dirpath).st_mode & stat.S_IWUSR, dirpath)
+        shutil.rmtree(home)
+        # materialized from the image, without fetching the package again
+        sent = self.server.sent
+        result = self.host.run(versions=[self.target], image_cache=True)[0]
+        self.assertTrue(result['changed'])
+        self.assertTrue(result['images'])
+        self.assertEqual(self.server.sent, sent)
+        self.assertEqual(result['metrics']['bytes_downloaded'], 0)
+        self.assertTrue(os.path.isfile(os.path.join(home, 'bin', 'java')))
+        self.assertTrue(os.stat(os.path.join(home, 'bin')).st_mode & stat.S_IWUSR)
+
+    def test_cds(self):
+        result = self.host.run(versions=[self.target], cds=True)[0]
+        self.assertTrue(result['changed'])
+        archives = result['cds'][0]['archives']
+        self.assertTrue(archives)
+        for archive in archives:
+            self.assertTrue(os.path.isfile(archive))
+            self.assertTrue(os.path.isfile(archive + '.stamp'))
+        result, module = self.host.run(versions=[self.target], cds=True)
+        self.assertFalse(result['changed'])
+        self.assertEqual(module.forks, 0)
+        # a new libjvm makes the archive stale
+        libjvm = os.path.join(os.path.dirname(archives[0]), 'libjvm.so')
+        with open(libjvm, 'ab') as f:
+            f.write(b'update')
+        result = self.host.run(versions=[self.target], cds=True)[0]
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['cds'][0]['archives'], archives)
+
+    def test_ergonomics(self):
+        self.host.run(state=self.state, ergonomics='env')
+        self.assertIn('-XX:+Use', self.env())
+        # the heap is only limited when asked for
+        self.assertNotIn('-Xmx', self.env())
+        result = self.host.run(state=self.state, ergonomics='env', ergonomics_heap_percent=25)[0]
+        self.assertTrue(result['changed'])
+        self.assertIn('-Xmx', self.env())
+        result, module = self.host.run(state=self.state, ergonomics='env', ergonomics_heap_percent=25)
+        self.assertFalse(result['changed'])
+        self.assertEqual(module.forks, 0)
+        # what it wrote goes once it is turned off
+        result = self.host.run(state=self.state)[0]
+        self.assertTrue(result['changed'])
+        self.assertNotIn('JAVA_TOOL_OPTIONS', self.env())
+
+    def test_mirror(self):
+        mirror = self.host.path('/srv/mirror')
+        self.host.makedirs(mirror)
+        path = os.path.join(mirror, '%s-7u76-linux-x64.tar.gz' % self.state)
+        with open(path, 'wb') as f:
+            f.write(self.package())
+        sent = self.server.sent
+        result = self.host.run(versions=[self.target], package_location=mirror)[0]
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['version'], '1.7.0_76')
+        self.assertEqual(self.server.sent, sent)
+        self.assertTrue(os.path.isdir(result['java_home']))
+
+    def test_mirror_corrupt(self):
+        mirror = self.host.path('/srv/mirror')
+        self.host.makedirs(mirror)
+        path = os.path.join(mirror, '%s-7u76-linux-x64.tar.gz' % self.state)
+        with open(path, 'wb') as f:
+            f.write(self.package()[:-1] + b'x')
+        with self.assertRaises(RuntimeError):
+            self.host.run(versions=[self.target], package_location=mirror)
+        # left for whoever manages the mirror
+        self.assertTrue(os.path.isfile(path))
+
+    def test_check_mode(self):
+        result, module = self.host.run(check_mode=True, versions=[self.target], cds=True)
+        self.assertTrue(result['changed'])
+        actions = [step['action'] for step in result['plan']]
+        self.assertIn('fetch', actions)
+        self.assertIn('cds', actions)
+        self.assertFalse(os.path.exists(result['java_home']))
+        self.assertEqual(self.env(), '')
+        self.assertEqual(self.server.sent, self.sent)
+        self.assertEqual(module.forks, 0)
+
+    def test_option_change(self):
+        self.host.run(state=self.state)
+        self.assertFalse(self.host.run(state=self.state)[0]['changed'])
+        result = self.host.run(state=self.state, java_tool_options='-Dbench=1')[0]
+        self.assertTrue(result['changed'])
+        self.assertIn('JAVA_TOOL_OPTIONS="-Dbench=1"', self.env())
+        # recorded once applied, and converged from then on
+        result, module = self.host.run(state=self.state, java_tool_options='-Dbench=1')
+        self.assertFalse(result['changed'])
+        self.assertEqual(module.forks, 0)
+
+
+class DebScenarios(Scenarios, unittest.TestCase):
+    distro = 'deb'
+    state = 'jre'
+
+
+class RhelScenarios(Scenarios, unittest.TestCase):
+    distro = 'rhel'
+    state = 'jdk'
+
+
+if __name__ == '__main__':
+    unittest.main()